@@ -0,0 +1,286 @@
+""" Endpoint benchmarks for the chat API.
+
+Each benchmark seeds a dataset of a given shape, then drives every endpoint through the Django test client, recording
+the latency and number of queries of every request.  Results are plain dictionaries so that they can be saved as JSON
+and compared between commits.
+"""
+import itertools
+import math
+import platform
+import subprocess
+import time
+from datetime import datetime
+from json import dumps, loads
+
+import django
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import datasets
+from .cache import get_recent_backend
+from .models import Message
+
+
+# Dataset shapes, from a quiet deployment to a busy one
+DATASETS = {
+    "small": {"users": 50, "rooms": 5, "members_per_room": 20, "messages_per_room": 200},
+    "large": {"users": 5000, "rooms": 20, "members_per_room": 2000, "messages_per_room": 20000},
+}
+
+# Maximum number of database queries each scenario may make, whatever the size of the dataset.  A scenario that
+# needs more queries as the data grows has an N+1 problem.  Scenarios that make several requests are budgeted for all
+# of them together.  The budgets count the savepoints issued when running inside a test transaction.
+QUERY_BUDGETS = {
+    # /api/users/, /api/users/<id>/
+    "users_list": 2,
+    # One query per chunk of 500 users, plus the one that finds the end, counted once the whole stream has been read
+    "users_stream": 2,
+    "user_item": 1,
+    "users_by_ids": 2,
+    "user_create_update_delete": 14,
+    # /api/rooms/, /api/rooms/<id>/
+    "rooms_list": 2,
+    "room_item": 1,
+    "room_create_delete": 7,
+    "rooms_by_activity": 5,
+    # /api/rooms/<id>/messages/, /api/rooms/<id>/messages/<id>/
+    "messages_newest": 1,
+    "messages_newest_uncached": 3,
+    "messages_scroll_back": 6,
+    "messages_not_modified": 2,
+    "messages_include_users": 3,
+    "message_item": 2,
+    "message_post": 6,
+    "message_post_batch": 9,
+    # /api/rooms/<id>/members/, /api/rooms/<id>/members/<id>/
+    "members_list": 4,
+    "members_list_sparse": 4,
+    "members_not_modified": 6,
+    "member_join_leave": 17,
+}
+
+
+def seed(users, rooms, members_per_room, messages_per_room):
+    """ Fill an empty database with a dataset of the given shape.
+    :return: Dictionary of IDs the endpoint scenarios need
+    """
+    if members_per_room >= users:
+        raise ValueError("There must be more users than members per room")
+
+    # Every room is equally popular, so each gets exactly the requested members and messages
+    dataset = datasets.generate(users, rooms, rooms * messages_per_room, members_per_room, skew=0, prefix="bench")
+
+    room_id = dataset["rooms"][0]
+    members = set(dataset["members"][room_id])
+
+    return {
+        "room": room_id,
+        "user": dataset["members"][room_id][0],
+        "outsider": next(user_id for user_id in dataset["users"] if user_id not in members),
+        "message": Message.objects.filter(room_id=room_id).order_by('-id').values_list('id', flat=True).first(),
+    }
+
+
+def _scenarios(ids):
+    """ Build the list of endpoint scenarios for a seeded dataset.
+
+    Each scenario is a (name, request function, setup function) tuple.  The request function is timed; the optional
+    setup function runs untimed before every request.
+    """
+    room_url = "/api/rooms/%d/" % ids["room"]
+    unique = itertools.count()
+    messages_url = room_url + "messages/"
+    members_url = room_url + "members/"
+
+    def clear_recent():
+        get_recent_backend().clear()
+
+    def get(url, **params):
+        return lambda client: client.get(url, params)
+
+    def post(url, data):
+        return lambda client: client.post(url, dumps(data), content_type='application/json')
+
+    def scroll_back(client):
+        # Page back through the history twice, following the cursor
+        page = loads(client.get(messages_url).content.decode('utf-8'))
+        return client.get(messages_url, {"before": page["before"]})
+
+    def conditional_get(url):
+        def request(client):
+            etag = client.get(url)['ETag']
+            return client.get(url, HTTP_IF_NONE_MATCH=etag)
+        return request
+
+    def create_update_delete_user(client):
+        user_url = "/api/users/%d/" % loads(client.post("/api/users/", dumps({
+            "nick": "bench-new-user-%d" % next(unique), "avatar": "http://example.com/new.png"
+        }), content_type='application/json').content.decode('utf-8'))["id"]
+        client.put(user_url, dumps({"avatar": "http://example.com/updated.png"}), content_type='application/json')
+        return client.delete(user_url)
+
+    def create_delete_room(client):
+        new_room_url = "/api/rooms/%d/" % loads(client.post("/api/rooms/", dumps({
+            "name": "bench-new-room-%d" % next(unique)
+        }), content_type='application/json').content.decode('utf-8'))["id"]
+        return client.delete(new_room_url)
+
+    def join_and_leave(client):
+        client.post(members_url, dumps({"user": ids["outsider"]}), content_type='application/json')
+        return client.delete(members_url + "%d/" % ids["outsider"])
+
+    return [
+        ("users_list", get("/api/users/"), None),
+        ("users_stream", get("/api/users/", stream=1), None),
+        ("user_item", get("/api/users/%d/" % ids["user"]), None),
+        ("users_by_ids", get("/api/users/", ids="%d,%d" % (ids["outsider"], ids["user"])), None),
+        ("user_create_update_delete", create_update_delete_user, None),
+        ("rooms_list", get("/api/rooms/"), None),
+        ("room_item", get(room_url), None),
+        ("room_create_delete", create_delete_room, None),
+        ("rooms_by_activity", get("/api/rooms/", include="activity", sort="activity"), None),
+        ("messages_newest", get(messages_url), None),
+        ("messages_newest_uncached", get(messages_url), clear_recent),
+        ("messages_scroll_back", scroll_back, clear_recent),
+        ("messages_not_modified", conditional_get(messages_url), None),
+        ("messages_include_users", get(messages_url, include="user"), None),
+        ("message_item", get(messages_url + "%d/" % ids["message"]), None),
+        ("message_post", post(messages_url, {"user": ids["user"], "msg": "benchmark"}), None),
+        ("message_post_batch", post(messages_url, [{"user": ids["user"], "msg": "benchmark"}] * 50), None),
+        ("members_list", get(members_url), None),
+        ("members_list_sparse", get(members_url, fields="nick"), None),
+        ("members_not_modified", conditional_get(members_url), None),
+        ("member_join_leave", join_and_leave, None),
+    ]
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a list of numbers. """
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def run_scenario(client, request, setup=None, iterations=100, warmup=10):
+    """ Time one endpoint scenario.
+    :return: Dictionary of latency percentiles (milliseconds), throughput and queries per request
+    """
+    latencies = []
+    queries = []
+
+    for iteration in range(warmup + iterations):
+        if setup:
+            setup()
+
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            response = request(client)
+
+            # A streamed response only runs its queries and encodes its chunks as it's read
+            if response.streaming:
+                b"".join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+
+        if response.status_code >= 400:
+            raise RuntimeError("Request failed with status %d" % response.status_code)
+
+        if iteration >= warmup:
+            latencies.append(elapsed)
+            queries.append(len(captured))
+
+    return {
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "requests_per_second": len(latencies) / sum(latencies),
+        "queries_per_request": sum(queries) / float(len(queries)),
+        "max_queries": max(queries),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(dataset, iterations=100, warmup=10, only=None, log=None):
+    """ Seed a dataset into the (empty) current database and benchmark every endpoint against it.
+    :param dataset: Dataset shape, see DATASETS
+    :param iterations: Timed requests per scenario
+    :param warmup: Untimed requests per scenario, run first
+    :param only: (optional) Names of the scenarios to run
+    :param log: (optional) Function called with a progress message for every scenario
+    :return: JSON-serializable results
+    """
+    ids = seed(**dataset)
+    client = Client()
+    results = {}
+
+    for name, request, setup in _scenarios(ids):
+        if only and name not in only:
+            continue
+
+        results[name] = run_scenario(client, request, setup, iterations, warmup)
+
+        if log:
+            log("%-28s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %8.1f req/s  %5.1f queries" % (
+                name, results[name]["p50_ms"], results[name]["p95_ms"], results[name]["p99_ms"],
+                results[name]["requests_per_second"], results[name]["queries_per_request"]))
+
+    return {
+        "commit": _git_commit(),
+        "created": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+        "dataset": dataset,
+        "iterations": iterations,
+        "scenarios": results,
+    }
+
+
+def compare(baseline, current, tolerance=0.2):
+    """ Compare two benchmark results.
+    :param baseline: Earlier results, as returned by run()
+    :param current: Later results
+    :param tolerance: Fraction by which p95 latency may grow before it counts as a regression
+    :return: List of (scenario, message) tuples describing regressions
+    """
+    regressions = []
+
+    for name, result in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+
+        if result["max_queries"] > before["max_queries"]:
+            regressions.append((name, "queries per request grew from %d to %d" % (before["max_queries"],
+                                                                                   result["max_queries"])))
+
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append((name, "p95 latency grew from %.2fms to %.2fms" % (before["p95_ms"],
+                                                                                   result["p95_ms"])))
+
+    return regressions
+
+
+def check_budgets(results, budgets=QUERY_BUDGETS):
+    """ Check benchmark results against the query budgets.
+    :param results: Results, as returned by run()
+    :param budgets: Dictionary of scenario name to the maximum number of queries it may make
+    :return: List of (scenario, message) tuples describing scenarios that went over budget or have no budget
+    """
+    overruns = []
+
+    for name, result in sorted(results["scenarios"].items()):
+        budget = budgets.get(name)
+
+        if budget is None:
+            overruns.append((name, "has no query budget"))
+        elif result["max_queries"] > budget:
+            overruns.append((name, "made %d queries, over its budget of %d" % (result["max_queries"], budget)))
+
+    return overruns
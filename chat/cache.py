@@ -0,0 +1,171 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class LocalLRUBackend(object):
+    """ In-process cache holding at most max_entries values, evicting the least recently used. """
+
+    def __init__(self, max_entries=1000, timeout=None):
+        """
+        :param max_entries: Maximum number of values held
+        :param timeout: (optional) Seconds after which a value is no longer served.  With several server processes,
+                each has its own copy, so this bounds how long one process can miss another's updates.
+        """
+        self._max_entries = max_entries
+        self._timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self._timeout if self._timeout is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend(object):
+    """ Stores values in one of Django's configured caches, which may be shared between server processes. """
+
+    def __init__(self, alias='default', timeout=300):
+        self._cache = caches[alias]
+        self._timeout = timeout
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value, self._timeout)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+
+_recent_backend = None
+
+
+def get_recent_backend():
+    """ Return the backend holding recent message windows, configured by the CHAT_RECENT_MESSAGES_CACHE setting. """
+    global _recent_backend
+
+    if _recent_backend is None:
+        config = getattr(settings, 'CHAT_RECENT_MESSAGES_CACHE', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.cache.LocalLRUBackend'))
+        _recent_backend = backend_class(**config.get('OPTIONS', {}))
+
+    return _recent_backend
+
+
+def _recent_key(room_id):
+    return 'chat:room:%s:recent' % room_id
+
+
+def _recent_epoch_key(room_id):
+    return 'chat:room:%s:recent-epoch' % room_id
+
+
+def _recent_revision_key(room_id):
+    return 'chat:room:%s:recent-revision' % room_id
+
+
+def get_recent_messages(room_id, appended=False):
+    """ Return the cached newest page of a room's history, or None if it isn't cached or has been invalidated.
+    :param appended: If True, also return a page that only lacks messages appended since it was cached.  The caller
+            must merge them in, e.g. with Room.newer_messages().
+    """
+    backend = get_recent_backend()
+    entry = backend.get(_recent_key(room_id))
+
+    if entry is None:
+        return None
+
+    (epoch, revision), page = entry
+    if epoch != backend.get(_recent_epoch_key(room_id)):
+        return None
+
+    if not appended and revision != backend.get(_recent_revision_key(room_id)):
+        return None
+
+    # Hand out a copy so that callers can't alter the cached page
+    return dict(page)
+
+
+def recent_messages_version(room_id):
+    """ Return the current version of a room's newest page, to be read before the page is read from the database and
+    passed to set_recent_messages().  If messages are posted in between, the version changes, so a slow reader can't
+    cache a page that misses them as current.
+    """
+    backend = get_recent_backend()
+    epoch = backend.get(_recent_epoch_key(room_id))
+
+    if epoch is None:
+        epoch = uuid.uuid4().hex
+        backend.set(_recent_epoch_key(room_id), epoch)
+
+    return epoch, backend.get(_recent_revision_key(room_id))
+
+
+def set_recent_messages(room_id, page, version):
+    """ Cache the newest page of a room's history, as returned by Room.messages().
+    :param version: Version returned by recent_messages_version() before the page was read
+    """
+    get_recent_backend().set(_recent_key(room_id), (version, dict(page)))
+
+
+def recent_messages_appended(room_id):
+    """ Mark a room's cached newest page as lacking messages that have been committed after everything in it.  The
+    page is kept, so that only the new messages need to be read and merged into it.  The revision is replaced
+    outright rather than read and incremented, so that concurrent posts can't undo each other or an invalidation.
+    """
+    get_recent_backend().set(_recent_revision_key(room_id), uuid.uuid4().hex)
+
+
+def invalidate_recent_messages(room_id):
+    """ Stop serving a room's cached newest page, e.g. once messages that sort inside it have been committed, or
+    messages have been deleted.  Dropping the epoch also retires any page being read from the database at the same
+    time, and any page that was only lacking appended messages.
+    """
+    backend = get_recent_backend()
+    backend.delete(_recent_epoch_key(room_id))
+    backend.delete(_recent_key(room_id))
+
+
+def forget_room(room_id):
+    """ Drop everything cached for a room, e.g. once it has been deleted. """
+    invalidate_recent_messages(room_id)
+    get_recent_backend().delete(_recent_revision_key(room_id))
@@ -0,0 +1,111 @@
+""" JSON encoding and decoding for the API.
+
+orjson is used when it's installed, and the standard library otherwise.  Both produce the same compact output, with
+dates and times formatted the way DjangoJSONEncoder formats them.
+
+Values that are already encoded can be wrapped in RawJSON, and are spliced into the output as they are instead of
+being decoded and encoded again.
+"""
+import binascii
+import datetime
+import decimal
+import json
+import os
+import re
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson can only splice raw fragments since version 3.9
+FAST = orjson is not None and hasattr(orjson, 'Fragment')
+
+
+class RawJSON(object):
+    """ A value that has already been encoded as JSON. """
+    __slots__ = ('encoded',)
+
+    def __init__(self, encoded):
+        """
+        :param encoded: UTF-8 encoded JSON bytes, or a JSON string
+        """
+        self.encoded = encoded.encode('utf-8') if isinstance(encoded, str) else encoded
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.encoded == other.encoded
+
+    def __repr__(self):
+        return 'RawJSON(%r)' % self.encoded
+
+
+def encode_value(value):
+    """ Encode the non-JSON types the API returns, exactly as DjangoJSONEncoder would. """
+    if isinstance(value, datetime.datetime):
+        text = value.isoformat()
+        if value.microsecond:
+            text = text[:23] + text[26:]
+        if text.endswith('+00:00'):
+            text = text[:-6] + 'Z'
+        return text
+    elif isinstance(value, datetime.date):
+        return value.isoformat()
+    elif isinstance(value, datetime.time):
+        text = value.isoformat()
+        if value.microsecond:
+            text = text[:12]
+        return text
+    elif isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def _fast_default(value):
+    if isinstance(value, RawJSON):
+        return orjson.Fragment(value.encoded)
+
+    return encode_value(value)
+
+
+def dumps(data):
+    """ Encode data as compact JSON.
+    :param data: JSON-serializable data, which may include RawJSON values
+    :return: UTF-8 encoded bytes
+    """
+    if FAST:
+        return orjson.dumps(data, default=_fast_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    fragments = []
+    nonce = []
+
+    def default(value):
+        if isinstance(value, RawJSON):
+            # Stand in a placeholder string, replaced with the fragment once everything else is encoded.  The nonce
+            # keeps placeholders from matching any string in the data itself.
+            if not nonce:
+                nonce.append(binascii.hexlify(os.urandom(8)).decode('ascii'))
+            fragments.append(value.encoded)
+            return '\x00%s:%d\x00' % (nonce[0], len(fragments) - 1)
+
+        return encode_value(value)
+
+    encoded = json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    if fragments:
+        placeholder = re.compile(rb'"\\u0000' + nonce[0].encode('ascii') + rb':(\d+)\\u0000"')
+        encoded = placeholder.sub(lambda match: fragments[int(match.group(1))], encoded)
+
+    return encoded
+
+
+def loads(data):
+    """ Decode JSON from bytes or a string.
+    :raises ValueError: If the data isn't valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
@@ -0,0 +1,128 @@
+""" Synthetic dataset generation, for load and scale testing.
+
+Datasets are generated from a seed, so the same parameters always produce the same rooms, memberships and messages.
+Rows are written with bulk inserts, one transaction per chunk, so that millions of messages can be generated without
+holding them all in memory.
+"""
+import random
+from datetime import datetime, timedelta
+
+from django.db import transaction
+
+from .models import CollectionVersion, User, Room, Message
+
+
+def popularity(rooms, skew):
+    """ Relative popularity of each room, following a Zipf-like distribution.
+    :param rooms: Number of rooms
+    :param skew: 0 makes every room equally popular; larger values concentrate activity in the first few rooms
+    :return: List of weights summing to 1, most popular room first
+    """
+    weights = [1.0 / (rank + 1) ** skew for rank in range(rooms)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def allocate(total, weights):
+    """ Split a total into whole numbers proportional to the weights, using the largest remainder method. """
+    shares = [total * weight for weight in weights]
+    counts = [int(share) for share in shares]
+
+    by_remainder = sorted(range(len(weights)), key=lambda index: shares[index] - counts[index], reverse=True)
+    for index in by_remainder[:total - sum(counts)]:
+        counts[index] += 1
+
+    return counts
+
+
+def _insert(model, objects, chunk_size):
+    """ Bulk insert objects, committing one chunk at a time. """
+    for start in range(0, len(objects), chunk_size):
+        with transaction.atomic():
+            model.objects.bulk_create(objects[start:start + chunk_size])
+
+
+def generate(users, rooms, messages, max_members, skew=1.0, seed=0, days=30, prefix="gen", chunk_size=5000,
+             log=None):
+    """ Generate a dataset.
+    :param users: Number of users
+    :param rooms: Number of rooms
+    :param messages: Total number of messages, shared between the rooms according to their popularity
+    :param max_members: Number of members of the most popular room.  Other rooms get members in proportion to their
+            popularity, and every room gets at least one member.
+    :param skew: Popularity skew between rooms, see popularity()
+    :param seed: Random seed
+    :param days: Messages are spread over this many days, ending now
+    :param prefix: Prefix for user nicknames and room names, which must be unique
+    :param chunk_size: Rows written per insert and transaction
+    :param log: (optional) Function called with progress messages
+    :return: Dictionary with the generated "users" and "rooms" IDs, and the "members" IDs of each room
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    if max_members > users:
+        raise ValueError("A room can't have more members than there are users")
+
+    if (User.objects.filter(nick__startswith="%s-user-" % prefix).exists() or
+            Room.objects.filter(name__startswith="%s-room-" % prefix).exists()):
+        raise ValueError("A dataset with prefix %r already exists, pick another prefix" % prefix)
+
+    _insert(User, [User(nick="%s-user-%d" % (prefix, index), avatar="http://example.com/%s/%d.png" % (prefix, index))
+                   for index in range(users)], chunk_size)
+    user_ids = list(User.objects.filter(nick__startswith="%s-user-" % prefix).order_by('id')
+                    .values_list('id', flat=True))
+    CollectionVersion.bump(User._meta.db_table)
+    log("Created %d users" % len(user_ids))
+
+    _insert(Room, [Room(name="%s-room-%d" % (prefix, index)) for index in range(rooms)], chunk_size)
+    room_ids = list(Room.objects.filter(name__startswith="%s-room-" % prefix).order_by('id')
+                    .values_list('id', flat=True))
+    CollectionVersion.bump(Room._meta.db_table)
+    log("Created %d rooms" % len(room_ids))
+
+    weights = popularity(rooms, skew)
+    members = {}
+    Membership = Room.members.through
+
+    for room_id, weight in zip(room_ids, weights):
+        member_count = max(1, int(round(max_members * weight / weights[0])))
+        members[room_id] = rng.sample(user_ids, member_count)
+        _insert(Membership, [Membership(room_id=room_id, user_id=user_id) for user_id in members[room_id]],
+                chunk_size)
+
+    log("Created %d memberships" % sum(len(room_members) for room_members in members.values()))
+
+    end = datetime.utcnow()
+    span = timedelta(days=days).total_seconds()
+
+    for room_id, message_count in zip(room_ids, allocate(messages, weights)):
+        room_members = members[room_id]
+        start = end - timedelta(seconds=span)
+
+        # Generate and insert one chunk at a time, so memory use doesn't grow with the room's history
+        for chunk_start in range(0, message_count, chunk_size):
+            chunk = []
+            for index in range(chunk_start, min(message_count, chunk_start + chunk_size)):
+                offset = span * index / message_count
+                msg = Message(room_id=room_id, user_id=rng.choice(room_members),
+                              msg="message %d in room %d" % (index, room_id),
+                              timestamp=start + timedelta(seconds=offset))
+                msg.render()
+                chunk.append(msg)
+
+            with transaction.atomic():
+                Message.objects.bulk_create(chunk)
+
+        log("Created %d messages in room %d" % (message_count, room_id))
+
+    # Bulk inserts bypass the rooms' maintained counters, so count everything once at the end.  This also dates each
+    # room's last activity to its back-dated newest message.
+    Room.reconcile_counters(room_ids)
+    log("Counted the messages and members of %d rooms" % len(room_ids))
+
+    return {
+        "users": user_ids,
+        "rooms": room_ids,
+        "members": members,
+    }
@@ -1,7 +1,22 @@
-from django.http import JsonResponse, HttpResponse
-from json import loads
-from gripcontrol import HttpStreamFormat
-from django_grip import set_hold_stream, publish
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http.response import HttpResponseBase
+from django.utils.http import parse_etags, quote_etag
+from hashlib import md5
+
+from . import codec
+from .metrics import timed
+from .publisher import get_publisher
+from .realtime import get_realtime_backend
+
+
+class JsonResponse(HttpResponse):
+    """ Response with a body encoded by the codec, keeping the native data it was encoded from so that other decorators
+    don't need to decode the body again.
+    """
+
+    def __init__(self, data, status=200):
+        super().__init__(codec.dumps(data), content_type='application/json', status=status)
+        self.data = data
 
 
 def json(view_func):
@@ -10,17 +25,36 @@ def json(view_func):
         if request.method == "GET":
             json_data = {k: v for k, v in request.GET.items()}
         elif request.body:
-            json_data = loads(request.body.decode('utf-8'))
+            json_data = codec.loads(request.body)
         else:
             json_data = {}
 
+        # Views can provide a cheap validator for their GET responses.  If the client already holds the current
+        # version, answer without running the view at all.
+        etag = None
+        if request.method == "GET" and hasattr(self, '_etag'):
+            validator = self._etag(json_data, *args, **kwargs)
+
+            if validator is not None:
+                digest = md5(("%r|%s" % (validator, request.META.get('QUERY_STRING', ''))).encode('utf-8')).hexdigest()
+                etag = quote_etag(digest)
+
+                if digest in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                    not_modified = HttpResponseNotModified()
+                    not_modified['ETag'] = etag
+                    return not_modified
+
         # Call the view handler
-        response = view_func(self, json_data, *args, **kwargs)
+        with timed("view"):
+            response = view_func(self, json_data, *args, **kwargs)
 
         # Translate the return into a JsonResponse if necessary.  This allows us to return native Python
         # data structures without having to remember to jsonify it.
-        if isinstance(response, HttpResponse):
-            # Most likely an error response.  Just pass it through
+        if isinstance(response, HttpResponseBase):
+            # Most likely an error response or a streamed response.  Just pass it through
+            if etag and response.status_code == 200:
+                response['ETag'] = etag
+
             return response
         else:
             # Return the appropriate HTTP status
@@ -31,17 +65,53 @@ def json(view_func):
             else:
                 status = 200
 
-            return JsonResponse(response, status=status)
+            with timed("encode"):
+                json_response = JsonResponse(response, status=status)
+
+            if etag:
+                json_response['ETag'] = etag
+            return json_response
 
     return wrapper
 
 
+def sse_event(event, data, event_id=None):
+    """ Format a single server-sent event.
+    :param event: Event name
+    :param data: Event payload, either already encoded JSON or a JSON-serializable object
+    :param event_id: (optional) Event ID, echoed back by the browser in Last-Event-ID when it reconnects
+    :return: Event text, ready to be written to an event stream
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    elif not isinstance(data, str):
+        data = codec.dumps(data).decode('utf-8')
+
+    if event_id is not None:
+        return 'id: %s\nevent: %s\ndata: %s\n\n' % (event_id, event, data)
+    else:
+        return 'event: %s\ndata: %s\n\n' % (event, data)
+
+
 def room_stream_subscriber(view_func):
     def wrapper(self, request, room_id, *args, **kwargs):
         """ Check if browser is attempting to subscribe to an event stream. """
         if request.META.get('HTTP_ACCEPT') == 'text/event-stream':
-            set_hold_stream(request, self._stream_name(room_id))
-            return HttpResponse(content_type='text/event-stream')
+            # A reconnecting browser tells us the last event it saw.  Replay whatever it missed before any new events,
+            # rather than making it refetch and diff the whole history.  The backend reads the replay once it's
+            # listening to the stream, so nothing published in between is lost.
+            last_event_id = request.META.get('HTTP_LAST_EVENT_ID')
+            replay = None
+
+            if last_event_id and hasattr(self, '_replay_events'):
+                def replay():
+                    return [(event_id, sse_event(event, data, event_id=event_id))
+                            for event, event_id, data in self._replay_events(room_id, last_event_id)]
+
+            try:
+                return get_realtime_backend().subscribe(request, self._stream_name(room_id), replay)
+            except ValueError as ex:
+                return HttpResponse(str(ex), status=400)
 
         return view_func(self, request, room_id, *args, **kwargs)
 
@@ -63,9 +133,17 @@ def room_stream_publisher(view_func):
             else:
                 event = "update"
 
-            # Got back a data object that needs to be published
-            update_content = [HttpStreamFormat('event: %s\ndata: %s\n\n' % (event, response.content))]
-            publish(self._stream_name(room_id), update_content)
+            # Views may split their response into several events (e.g. a batch of messages) or tag them with IDs
+            if hasattr(self, '_stream_events'):
+                event_text = ''.join(sse_event(stream_event, data, event_id=event_id)
+                                     for stream_event, event_id, data in self._stream_events(event, response.data))
+            else:
+                event_text = sse_event(event, response.content)
+
+            # Got back a data object that needs to be published.  This only queues it, the request doesn't wait for
+            # the proxy, and a batch goes out as a single payload.
+            with timed("publish"):
+                get_publisher().publish(self._stream_name(room_id), event_text)
 
         return response
 
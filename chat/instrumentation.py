@@ -0,0 +1,93 @@
+""" Database query instrumentation.
+
+Each connection is instrumented once, with a cursor that times every query and passes it to the hooks watching the
+current thread: the metrics of the request being served, slow query capture and the profiler's query log.  Hooks are
+registered per thread, by the request being served on it, so that each only sees that request's queries and the
+cursor does no more than run the query when nothing is watching.
+"""
+import threading
+import time
+
+
+_local = threading.local()
+
+
+def _hooks():
+    if getattr(_local, 'hooks', None) is None:
+        _local.hooks = []
+
+    return _local.hooks
+
+
+class InstrumentedCursor(object):
+    """ Wraps a database cursor, passing every query it runs to the hooks watching the current thread. """
+
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self, method, sql, params):
+        hooks = _hooks()
+
+        if not hooks:
+            return method(sql, params)
+
+        start = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+
+            # A copy, as hooks may run queries of their own, or stop watching
+            for hook in list(hooks):
+                hook(self._connection, sql, params, elapsed)
+
+    def execute(self, sql, params=None):
+        return self._run(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._run(self._cursor.executemany, sql, param_list)
+
+
+def instrument_connection(connection):
+    """ Make every cursor of a database connection pass its queries to the current thread's hooks.  Safe to call
+    repeatedly.
+    """
+    if getattr(connection, '_chat_instrumented', False):
+        return
+
+    make_cursor = connection.cursor
+    connection.cursor = lambda: InstrumentedCursor(make_cursor(), connection)
+    connection._chat_instrumented = True
+
+
+def add_hook(hook):
+    """ Call hook(connection, sql, params, elapsed) after every query this thread runs on an instrumented connection,
+    until remove_hook() is called.  For executemany(), params is the list of parameter sets.  Adding a hook that is
+    already registered does nothing.
+    """
+    hooks = _hooks()
+
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def remove_hook(hook):
+    """ Stop calling a hook registered by add_hook().  Does nothing if it isn't registered. """
+    hooks = _hooks()
+
+    if hook in hooks:
+        hooks.remove(hook)
+
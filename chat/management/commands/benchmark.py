@@ -0,0 +1,73 @@
+from json import dump, load
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from chat import benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmark every API endpoint against a seeded dataset, in a throwaway test database."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dataset', default='small', choices=sorted(benchmark.DATASETS),
+                    help="Dataset shape to seed (%s)" % ", ".join(sorted(benchmark.DATASETS))),
+        make_option('--users', type='int', help="Override the number of users in the dataset"),
+        make_option('--rooms', type='int', help="Override the number of rooms in the dataset"),
+        make_option('--members-per-room', type='int', help="Override the number of members of each room"),
+        make_option('--messages-per-room', type='int', help="Override the number of messages in each room"),
+        make_option('--iterations', type='int', default=100, help="Timed requests per endpoint"),
+        make_option('--warmup', type='int', default=10, help="Untimed requests per endpoint, run first"),
+        make_option('--only', action='append', help="Only run this scenario (may be repeated)"),
+        make_option('--output', help="Save the results to this JSON file"),
+        make_option('--compare', help="Compare the results with an earlier JSON results file"),
+        make_option('--check-budgets', action='store_true', default=False,
+                    help="Fail if any scenario makes more queries than its budget"),
+        make_option('--tolerance', type='float', default=0.2,
+                    help="Fraction by which p95 latency may grow before --compare reports a regression"),
+    )
+
+    def handle(self, *args, **options):
+        dataset = dict(benchmark.DATASETS[options['dataset']])
+        for key in dataset:
+            if options.get(key) is not None:
+                dataset[key] = options[key]
+
+        # Never benchmark against real data
+        old_database_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            results = benchmark.run(dataset, iterations=options['iterations'], warmup=options['warmup'],
+                                    only=options['only'], log=self.stdout.write)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                dump(results, output_file, indent=2, sort_keys=True)
+
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                regressions = benchmark.compare(load(baseline_file), results, options['tolerance'])
+
+            for name, message in regressions:
+                self.stderr.write("REGRESSION %s: %s" % (name, message))
+
+            if regressions:
+                raise CommandError("%d performance regressions" % len(regressions))
+
+        if options['check_budgets']:
+            overruns = benchmark.check_budgets(results)
+
+            for name, message in overruns:
+                self.stderr.write("OVER BUDGET %s: %s" % (name, message))
+
+            if overruns:
+                raise CommandError("%d scenarios over their query budget" % len(overruns))
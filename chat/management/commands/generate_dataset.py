@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import datasets
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a seeded, synthetic dataset of users, rooms, memberships and messages."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=1000, help="Number of users"),
+        make_option('--rooms', type='int', default=50, help="Number of rooms"),
+        make_option('--messages', type='int', default=100000, help="Total number of messages"),
+        make_option('--max-members', type='int', default=500, help="Number of members of the most popular room"),
+        make_option('--skew', type='float', default=1.0,
+                    help="Popularity skew between rooms; 0 makes every room equally popular"),
+        make_option('--seed', type='int', default=0, help="Random seed"),
+        make_option('--days', type='int', default=30, help="Spread messages over this many days"),
+        make_option('--prefix', default='gen', help="Prefix for user nicknames and room names"),
+        make_option('--chunk-size', type='int', default=5000, help="Rows written per insert and transaction"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            datasets.generate(options['users'], options['rooms'], options['messages'], options['max_members'],
+                              skew=options['skew'], seed=options['seed'], days=options['days'],
+                              prefix=options['prefix'], chunk_size=options['chunk_size'], log=self.stdout.write)
+        except ValueError as ex:
+            raise CommandError(str(ex))
@@ -0,0 +1,25 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = "Recount the messages and members of rooms, and correct any maintained counters that have drifted."
+    args = "[room_id ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Report drifted counters without correcting them"),
+    )
+
+    def handle(self, *args, **options):
+        room_ids = [int(room_id) for room_id in args] or None
+        drifted = Room.reconcile_counters(room_ids, dry_run=options['dry_run'])
+
+        for room_id, corrections in sorted(drifted.items()):
+            self.stdout.write("Room %d: %s" % (room_id, ", ".join("%s=%s" % (name, value)
+                                                                   for name, value in sorted(corrections.items()))))
+
+        self.stdout.write("%d rooms %s" % (len(drifted), "drifted" if options['dry_run'] else "corrected"))
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from chat.models import SlowQuery
+
+
+class Command(BaseCommand):
+    help = "Print the recorded slow queries, those with the most total time first, along with their plans."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=20, help="Number of queries to print"),
+        make_option('--no-plans', action='store_false', dest='plans', default=True, help="Leave out query plans"),
+        make_option('--clear', action='store_true', default=False, help="Forget every recorded slow query"),
+    )
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            SlowQuery.objects.all().delete()
+            return
+
+        for rank, entry in enumerate(SlowQuery.objects.order_by('-total_time')[:options['limit']], 1):
+            self.stdout.write("#%d  %d occurrences, %.3fs total, %.3fs mean, %.3fs max, last seen %s" % (
+                rank, entry.count, entry.total_time, entry.total_time / entry.count, entry.max_time,
+                entry.last_seen.isoformat()))
+            self.stdout.write(entry.normalized)
+            self.stdout.write("Slowest: %s" % entry.example)
+
+            if options['plans'] and entry.plan:
+                self.stdout.write(entry.plan)
+
+            self.stdout.write("")
@@ -0,0 +1,169 @@
+""" In-process performance metrics.
+
+Requests are broken down into phases (database, view code, JSON encoding, publishing), which are accumulated per
+request and then aggregated into histograms labelled by view and HTTP verb.  Histograms are rendered in the Prometheus
+text format so that they can be scraped.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from . import instrumentation
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Metric name: (description, buckets)
+HISTOGRAMS = {
+    "chat_request_seconds": ("Wall time of each request", LATENCY_BUCKETS),
+    "chat_request_db_seconds": ("Time spent running database queries per request", LATENCY_BUCKETS),
+    "chat_request_python_seconds": ("Time spent in view code outside the database per request, mostly "
+                                    "serialization", LATENCY_BUCKETS),
+    "chat_request_encode_seconds": ("Time spent encoding the JSON response per request", LATENCY_BUCKETS),
+    "chat_request_publish_seconds": ("Time spent handing stream events to the publisher per request",
+                                     LATENCY_BUCKETS),
+    "chat_request_queries": ("Database queries per request", COUNT_BUCKETS),
+    "chat_response_bytes": ("Response body size", SIZE_BUCKETS),
+    "chat_publish_seconds": ("Latency of each call to the realtime backend", LATENCY_BUCKETS),
+    "chat_fanout_seconds": ("Time from publishing an event to handing it to an in-process hub subscriber",
+                            LATENCY_BUCKETS),
+}
+
+
+class Histogram(object):
+    """ Fixed bucket histogram.  Not thread-safe on its own; the registry serializes access. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {}
+_local = threading.local()
+
+
+def observe(name, value, **labels):
+    """ Record a value in the histogram with the given name and labels. """
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        histogram = _histograms.get(key)
+
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(HISTOGRAMS[name][1])
+
+        histogram.observe(value)
+
+
+def reset():
+    """ Forget every recorded value. """
+    with _lock:
+        _histograms.clear()
+
+
+def _count_query(connection, sql, params, elapsed):
+    add_to_phase("db", elapsed)
+    add_to_phase("queries", 1)
+
+
+def start_request():
+    """ Start accumulating phase timings for the request being handled by this thread, including the time spent in
+    queries on instrumented connections, see chat.instrumentation.
+    """
+    _local.phases = {"db": 0.0, "queries": 0, "view": 0.0, "encode": 0.0, "publish": 0.0}
+    instrumentation.add_hook(_count_query)
+
+
+def finish_request():
+    """ Stop accumulating phase timings for this thread.
+    :return: The accumulated timings, or None if no request was started
+    """
+    instrumentation.remove_hook(_count_query)
+    phases = getattr(_local, 'phases', None)
+    _local.phases = None
+    return phases
+
+
+def add_to_phase(phase, amount):
+    """ Add to one of the current request's phase totals.  Does nothing outside an instrumented request. """
+    phases = getattr(_local, 'phases', None)
+
+    if phases is not None:
+        phases[phase] += amount
+
+
+@contextmanager
+def paused():
+    """ Leave the enclosed block out of the current request's phases, e.g. for bookkeeping queries that aren't part of
+    serving it.
+    """
+    phases, _local.phases = getattr(_local, 'phases', None), None
+    try:
+        yield
+    finally:
+        _local.phases = phases
+
+
+@contextmanager
+def timed(phase):
+    """ Time the enclosed block and add it to one of the current request's phases. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_to_phase(phase, time.perf_counter() - start)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+def render(extra=None):
+    """ Render every histogram, plus any extra values, in the Prometheus text exposition format.
+    :param extra: (optional) Dictionary of metric name to (metric type, description, value), for counters and gauges
+            kept elsewhere
+    :return: Text to serve from a metrics endpoint
+    """
+    with _lock:
+        snapshot = [(name, labels, list(histogram.counts), histogram.sum, histogram.count)
+                    for (name, labels), histogram in sorted(_histograms.items())]
+
+    lines = []
+    described = set()
+
+    for name, labels, counts, total, count in snapshot:
+        if name not in described:
+            lines.append('# HELP %s %s' % (name, HISTOGRAMS[name][0]))
+            lines.append('# TYPE %s histogram' % name)
+            described.add(name)
+
+        cumulative = 0
+        for bound, bucket_count in zip(HISTOGRAMS[name][1] + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', bound)]), cumulative))
+
+        lines.append('%s_sum%s %r' % (name, _format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+
+    for name, (metric_type, description, value) in sorted((extra or {}).items()):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('%s %r' % (name, value))
+
+    return '\n'.join(lines) + '\n'
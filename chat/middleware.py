@@ -0,0 +1,199 @@
+import cProfile
+import logging
+import os
+import random
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.crypto import constant_time_compare
+
+from . import instrumentation, metrics, slowqueries
+
+
+logger = logging.getLogger(__name__)
+
+
+def view_name(view_func):
+    """ Label for a view: the class name for class-based views, the function name otherwise. """
+    view_class = getattr(view_func, 'view_class', None)
+    return view_class.__name__ if view_class else view_func.__name__
+
+
+class MetricsMiddleware(object):
+    """ Records the time each request spends in the database, in view code, encoding JSON and publishing, along with
+    its query count and response size.  Requests are labelled by view and HTTP verb.
+    """
+
+    def process_request(self, request):
+        for connection in connections.all():
+            instrumentation.instrument_connection(connection)
+
+        request._metrics_start = time.perf_counter()
+        request._metrics_view = None
+        metrics.start_request()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_name(view_func)
+
+    def process_response(self, request, response):
+        # Streamed collections are read from the database as they're sent, so they're measured once they're finished.
+        # Event streams stay open for as long as the subscriber is connected, and are only measured up to here.
+        if response.streaming and not response.get('Content-Type', '').startswith('text/event-stream'):
+            response.streaming_content = self._measure_stream(request, response.streaming_content)
+        else:
+            self._record(request, metrics.finish_request(),
+                         None if response.streaming else len(response.content))
+
+        return response
+
+    def _measure_stream(self, request, content):
+        size = 0
+
+        try:
+            for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self._record(request, metrics.finish_request(), size)
+
+    def _record(self, request, phases, size):
+        # Requests that didn't resolve to a view (e.g. 404s from the URL resolver) aren't worth a label of their own
+        if phases is None or getattr(request, '_metrics_view', None) is None:
+            return
+
+        labels = {"view": request._metrics_view, "method": request.method}
+
+        metrics.observe("chat_request_seconds", time.perf_counter() - request._metrics_start, **labels)
+        metrics.observe("chat_request_db_seconds", phases["db"], **labels)
+        metrics.observe("chat_request_python_seconds", max(0.0, phases["view"] - phases["db"]), **labels)
+        metrics.observe("chat_request_encode_seconds", phases["encode"], **labels)
+        metrics.observe("chat_request_publish_seconds", phases["publish"], **labels)
+        metrics.observe("chat_request_queries", phases["queries"], **labels)
+
+        if size is not None:
+            metrics.observe("chat_response_bytes", size, **labels)
+
+
+class QueryLog(object):
+    """ Collects the SQL and time of each query run on a connection while the context is active. """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = []
+
+    def _log(self, connection, sql, params, elapsed):
+        if connection is self._connection:
+            self.queries.append({"sql": sql, "time": "%.3f" % elapsed})
+
+    def __enter__(self):
+        instrumentation.instrument_connection(self._connection)
+        instrumentation.add_hook(self._log)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        instrumentation.remove_hook(self._log)
+
+
+class ProfilingMiddleware(object):
+    """ Runs a sample of requests under the profiler, writing the call graph and the SQL executed by each to
+    CHAT_PROFILE_DIR.  A request is profiled if it carries an X-Chat-Profile header matching CHAT_PROFILE_TOKEN, or
+    is picked at random according to CHAT_PROFILE_SAMPLE_RATE.  Does nothing unless one of those is configured.
+
+    Each request produces a .prof file, readable with pstats or snakeviz, and a .sql file listing the queries with
+    their times.  File names are tagged with the view, room and duration of the request.  Only the newest
+    CHAT_PROFILE_MAX_FILES profiles are kept.
+    """
+
+    def __init__(self):
+        self._token = getattr(settings, 'CHAT_PROFILE_TOKEN', None)
+        self._sample_rate = getattr(settings, 'CHAT_PROFILE_SAMPLE_RATE', 0)
+        self._directory = getattr(settings, 'CHAT_PROFILE_DIR', 'profiles')
+        self._max_files = getattr(settings, 'CHAT_PROFILE_MAX_FILES', 500)
+
+        if not self._token and not self._sample_rate:
+            raise MiddlewareNotUsed()
+
+    def _wanted(self, request):
+        header = request.META.get('HTTP_X_CHAT_PROFILE')
+
+        if header is not None and self._token:
+            return constant_time_compare(header, self._token)
+
+        return random.random() < self._sample_rate
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self._wanted(request):
+            return None
+
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+
+        with QueryLog(connections[DEFAULT_DB_ALIAS]) as queries:
+            try:
+                response = profiler.runcall(view_func, request, *view_args, **view_kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self._dump(request, view_name(view_func), view_kwargs, elapsed, profiler, queries)
+
+        return response
+
+    def _dump(self, request, name, view_kwargs, elapsed, profiler, queries):
+        """ Write one request's profile and SQL, tagged with the view, room and duration. """
+        # Room URLs name the room item_id, every other room resource names it room_id
+        room_id = view_kwargs.get('item_id' if name == 'RoomView' else 'room_id', '-')
+        tag = "%s-%s-%s-room%s-%dms" % (datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'), name, request.method,
+                                       room_id, elapsed * 1000)
+        path = os.path.join(self._directory, tag)
+
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            profiler.dump_stats(path + '.prof')
+
+            with open(path + '.sql', 'w') as sql_file:
+                sql_file.write("-- %s %s, %d queries, %.1fms\n" % (request.method, request.get_full_path(),
+                                                                    len(queries.queries), elapsed * 1000))
+                for query in queries.queries:
+                    sql_file.write("-- %ss\n%s;\n" % (query['time'], query['sql']))
+
+            self._prune()
+        except OSError:
+            # Profiling must never break the request it's watching
+            logger.exception("Failed to write profile %s", path)
+
+    def _prune(self):
+        """ Delete the oldest profiles beyond CHAT_PROFILE_MAX_FILES.  Names start with a timestamp, so they sort by
+        age.
+        """
+        profiles = sorted(name[:-len('.prof')] for name in os.listdir(self._directory) if name.endswith('.prof'))
+
+        for tag in profiles[:max(0, len(profiles) - self._max_files)]:
+            for extension in ('.prof', '.sql'):
+                try:
+                    os.remove(os.path.join(self._directory, tag + extension))
+                except FileNotFoundError:
+                    pass
+
+
+class SlowQueryMiddleware(object):
+    """ Records database queries that take longer than CHAT_SLOW_QUERY_THRESHOLD seconds, see chat.slowqueries.  Does
+    nothing unless the threshold is set.
+    """
+
+    def __init__(self):
+        self._threshold = getattr(settings, 'CHAT_SLOW_QUERY_THRESHOLD', None)
+
+        if self._threshold is None:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        for connection in connections.all():
+            instrumentation.instrument_connection(connection)
+
+        slowqueries.watch(self._threshold)
+
+    def process_response(self, request, response):
+        slowqueries.flush()
+        return response
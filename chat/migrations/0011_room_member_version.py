@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_room_timestamp_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='member_version',
+            field=models.PositiveIntegerField(verbose_name='membership version', default=0),
+            preserve_default=True,
+        ),
+    ]
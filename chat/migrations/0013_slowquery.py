@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import chat.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_room_member_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('fingerprint', models.CharField(verbose_name='hash of the normalised SQL', max_length=40,
+                                                 unique=True)),
+                ('normalized', models.TextField(verbose_name='SQL with literals and parameters replaced by '
+                                                             'placeholders')),
+                ('example', models.TextField(verbose_name='SQL and parameters of the slowest occurrence')),
+                ('plan', models.TextField(verbose_name='query plan of the slowest occurrence', blank=True)),
+                ('count', models.PositiveIntegerField(verbose_name='number of slow occurrences', default=0)),
+                ('total_time', models.FloatField(verbose_name='total seconds spent in slow occurrences', default=0,
+                                                 db_index=True)),
+                ('max_time', models.FloatField(verbose_name='seconds taken by the slowest occurrence', default=0)),
+                ('last_seen', models.DateTimeField(verbose_name='last slow occurrence', default=chat.models.get_now)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import models, migrations, transaction
+
+
+# Messages rendered per UPDATE.  Each message takes three query parameters, and older SQLite builds allow 999.
+CHUNK_SIZE = 300
+
+
+def _timestamp(value):
+    """ Format a timestamp the way the API does at the time of this migration: ISO 8601 to the millisecond. """
+    text = value.isoformat()
+    if value.microsecond:
+        text = text[:23] + text[26:]
+    if text.endswith('+00:00'):
+        text = text[:-6] + 'Z'
+    return text
+
+
+def _render(msg):
+    """ Encode a message's public representation, less its ID, as JSON object members without the braces.  Inlined,
+    rather than using the current encoder, so that this migration keeps producing what it did when it was written.
+    """
+    data = {"room": msg.room_id, "user": msg.user_id, "msg": msg.msg, "timestamp": _timestamp(msg.timestamp)}
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))[1:-1]
+
+
+def render_messages(apps, schema_editor):
+    """ Store the encoded public representation of every existing message, with one UPDATE per chunk. """
+    Message = apps.get_model('chat', 'Message')
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    last_id = 0
+
+    while True:
+        chunk = list(Message.objects.filter(id__gt=last_id).order_by('id')
+                     .only('id', 'room', 'user', 'msg', 'timestamp')[:CHUNK_SIZE])
+        if not chunk:
+            break
+
+        params = []
+        for msg in chunk:
+            params.extend([msg.id, _render(msg)])
+        params.extend(msg.id for msg in chunk)
+
+        with transaction.atomic():
+            connection.cursor().execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+                quote(Message._meta.db_table), quote('rendered'), quote('id'),
+                ' '.join(['WHEN %s THEN %s'] * len(chunk)), quote('id'), ', '.join(['%s'] * len(chunk))), params)
+
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_slowquery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='rendered',
+            field=models.TextField(verbose_name='encoded public representation, without the ID', default='',
+                                   editable=False),
+            preserve_default=True,
+        ),
+        migrations.RunPython(render_messages, lambda apps, schema_editor: None),
+    ]
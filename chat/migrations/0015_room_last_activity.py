@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Max
+import chat.models
+
+
+def mark_activity(apps, schema_editor):
+    """ Set the last activity of every room with messages to the time of its newest message. """
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+
+    for row in Message.objects.values('room').annotate(newest=Max('timestamp')):
+        Room.objects.filter(id=row["room"]).update(last_activity=row["newest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_message_rendered'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_activity',
+            field=models.DateTimeField(verbose_name='time of the newest message, or of creation',
+                                       default=chat.models.get_now),
+            preserve_default=True,
+        ),
+        migrations.AlterIndexTogether(
+            name='room',
+            index_together=set([('last_activity', 'id')]),
+        ),
+        migrations.RunPython(mark_activity, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations, transaction
+from django.db.models import Count, Max
+
+
+# Rooms counted per UPDATE.  Each room takes seven query parameters, and older SQLite builds allow 999.
+CHUNK_SIZE = 100
+
+
+def count_rooms(apps, schema_editor):
+    """ Set the counters of every room from its existing messages and memberships, with one UPDATE per chunk of
+    rooms.  The newest message is the one with the highest ID at the newest timestamp, the order history is read in.
+    """
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    last_id = 0
+
+    while True:
+        room_ids = list(Room.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:CHUNK_SIZE])
+        if not room_ids:
+            break
+
+        messages = Message.objects.filter(room_id__in=room_ids).values('room')
+        messages = {row["room"]: row for row in messages.annotate(count=Count('id'), last=Max('timestamp'))}
+
+        newest = Message.objects.filter(room_id__in=messages, timestamp__in={row["last"] for row in messages.values()})
+        newest_ids = {}
+        for row in newest.values('room', 'timestamp').annotate(newest=Max('id')):
+            if row["timestamp"] == messages[row["room"]]["last"]:
+                newest_ids[row["room"]] = row["newest"]
+
+        members = Room.members.through.objects.filter(room_id__in=room_ids).values('room')
+        members = {row["room"]: row["count"] for row in members.annotate(count=Count('id'))}
+
+        # Rooms without messages or members keep the defaults the columns were added with
+        columns = [
+            ('message_count', {room_id: row["count"] for room_id, row in messages.items()}),
+            ('member_count', members),
+            ('last_message_id', newest_ids),
+        ]
+
+        params = []
+        assignments = []
+        for column, values in columns:
+            if values:
+                assignments.append("%s = CASE %s %s ELSE %s END" % (
+                    quote(column), quote('id'), ' '.join(['WHEN %s THEN %s'] * len(values)), quote(column)))
+                for room_id, value in sorted(values.items()):
+                    params.extend([room_id, value])
+
+        if assignments:
+            params.extend(room_ids)
+            with transaction.atomic():
+                connection.cursor().execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+                    quote(Room._meta.db_table), ', '.join(assignments), quote('id'),
+                    ', '.join(['%s'] * len(room_ids))), params)
+
+        last_id = room_ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_room_last_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(verbose_name='number of messages', default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='member_count',
+            field=models.PositiveIntegerField(verbose_name='number of members', default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_id',
+            field=models.IntegerField(verbose_name='ID of the newest message', null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(count_rooms, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def create_versions(apps, schema_editor):
+    """ Start the versioned collections at version 1, so that existing data has a validator before its next write. """
+    CollectionVersion = apps.get_model('chat', 'CollectionVersion')
+
+    for name in ('chat_user', 'chat_room'):
+        CollectionVersion.objects.create(name=name, version=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_room_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CollectionVersion',
+            fields=[
+                ('name', models.CharField(verbose_name='collection name', primary_key=True, max_length=100,
+                                          serialize=False)),
+                ('version', models.PositiveIntegerField(verbose_name='version', default=0)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(create_versions, lambda apps, schema_editor: None),
+    ]
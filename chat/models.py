@@ -1,14 +1,21 @@
 from django.db import models
-from django.forms import model_to_dict
+from django.db.models import Count, F, Max, Q
+from django.db import transaction
 import django.db
 from django.http import HttpResponse
 from datetime import datetime
 
+from . import cache as room_cache
+from .codec import RawJSON, dumps
+from .pagination import encode_message_cursor
+
 
 class ExtendedModel(models.Model):
     """ Extension of the Django model.Model class aimed at wrapping model data and database error conditions in more
     Restful responses.  Also supports whitelisting of model fields for easy filtering of public representations.
     """
+    # Whether writes through save() and delete() bump the collection's version, see collection_version()
+    versioned = False
 
     def update_data(self, *args, **kwargs):
         """  Update this object's data from the keyword arguments passed in.  This only updates the object in memory,
@@ -25,6 +32,9 @@ class ExtendedModel(models.Model):
             # Call the models.Model save method, passing along any positional or named arguments
             super().save(*args, **kwargs)
 
+            if self.versioned:
+                CollectionVersion.bump(self._meta.db_table)
+
             # Return the save object's public representation
             return self.to_data()
 
@@ -45,6 +55,9 @@ class ExtendedModel(models.Model):
             # Call the models.Model delete method, passing along any positional or named arguments
             super().delete(*args, **kwargs)
 
+            if self.versioned:
+                CollectionVersion.bump(self._meta.db_table)
+
             # Return the data that was deleted
             return self.to_data()
 
@@ -62,21 +75,71 @@ class ExtendedModel(models.Model):
         """
         return [field.name for field in self._meta.fields]
 
-    def to_data(self):
-        """ Iterate over all attributes and return a native Python dictionary containing only the whitelisted
-        attributes
+    @classmethod
+    def serializer_plan(cls):
+        """ Build (once per model class) the list of fields making up this model's public representation.
+        :return: Tuple of (field name, attribute name) pairs, one for each whitelisted concrete field.
         """
-        data = {}
+        # Look in the class' own dictionary so that subclasses don't pick up their parent's plan
+        plan = cls.__dict__.get('_serializer_plan')
+
+        if plan is None:
+            # Whitelists are a property of the model, not of any one instance, so evaluate it against the class
+            white_list = set(cls.white_list(cls))
+            plan = tuple((field.name, field.attname) for field in cls._meta.concrete_fields
+                         if field.name in white_list)
+            cls._serializer_plan = plan
 
-        # Retrieve our white list
-        white_list = self.white_list()
+        return plan
 
-        # Iterate over each of our fields and return a dictionary that contains only whitelisted fields.
-        for attr_name, attr_val in model_to_dict(self).items():
-            if attr_name in white_list:
-                data[attr_name] = attr_val
+    # Fields included in every sparse fieldset, because paging depends on them
+    required_fields = ('id',)
 
-        return data
+    @classmethod
+    def parse_fields(cls, fields):
+        """ Parse a sparse fieldset requested by a client.
+        :param fields: Comma separated list of field names, or None
+        :return: Names of the whitelisted fields to include, in whitelist order, or None for all of them
+        :raises ValueError: If a field isn't part of the public representation
+        """
+        if not fields:
+            return None
+
+        requested = set(fields.split(",")) - {''}
+        available = [name for name, attname in cls.serializer_plan()]
+        unknown = requested - set(available)
+
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+
+        requested.update(cls.required_fields)
+        return [name for name in available if name in requested]
+
+    @classmethod
+    def data_values(cls, query_set=None, fields=None):
+        """ Read public representations straight from the database, without building model instances.
+        :param query_set: (optional) Query set to read from.  Defaults to all objects of this model.
+        :param fields: (optional) Sparse fieldset, as returned by parse_fields().  Only these columns are read.
+        :return: Values query set yielding the same dictionaries that to_data() would return.
+        """
+        if query_set is None:
+            query_set = cls.objects.all()
+
+        # values() names foreign keys by field name and yields their ID, just like to_data()
+        return query_set.values(*(fields or [name for name, attname in cls.serializer_plan()]))
+
+    @classmethod
+    def collection_version(cls):
+        """ Cheap validator for the whole collection, a single primary key lookup, which changes whenever an object is
+        created, updated or deleted.  Only supported by versioned models; writes that bypass save() and delete() (e.g.
+        bulk inserts and query set updates) must call CollectionVersion.bump() themselves.
+        :return: Hashable value, or None if the collection has never been written
+        """
+        return CollectionVersion.of(cls._meta.db_table)
+
+    def to_data(self):
+        """ Return a native Python dictionary containing only the whitelisted attributes """
+        return {name: getattr(self, attname) for name, attname in self.serializer_plan()}
 
     class Meta:
         """ Don't create this class in the database, it's not a true model. """
@@ -87,17 +150,91 @@ def get_now():
     return datetime.utcnow()
 
 
+class CollectionVersion(models.Model):
+    """ Version number of a collection, bumped by every write to it, so that collection validators are a single
+    lookup rather than an aggregate over the whole table.
+    """
+    name = models.CharField("collection name", max_length=100, primary_key=True)
+    version = models.PositiveIntegerField("version", default=0)
+
+    @classmethod
+    def bump(cls, name):
+        """ Increment a collection's version, creating it on the first write. """
+        if cls.objects.filter(name=name).update(version=F('version') + 1):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, version=1)
+        except django.db.IntegrityError:
+            # Created by a concurrent first write
+            cls.objects.filter(name=name).update(version=F('version') + 1)
+
+    @classmethod
+    def of(cls, name):
+        """ Read a collection's version.
+        :return: The version, or None if the collection has never been written
+        """
+        return cls.objects.filter(name=name).values_list('version', flat=True).first()
+
+
 class User(ExtendedModel):
     """ A global user within the chat system. """
     nick = models.CharField("user nickname", max_length=100, unique=True, default=None)
     avatar = models.URLField("avatar url", max_length=512, default=None, blank=True)
     last_seen = models.DateTimeField("last time the user logged in", default=get_now)
 
+    versioned = True
+
+    def white_list(self):
+        """ Whitelist override
+        :return: List of fields to be included in API call responses.
+        """
+        return [
+            'id',
+            'nick',
+            'avatar',
+            'last_seen'
+        ]
+
+    def delete(self, *args, **kwargs):
+        """ Delete this user.  The database also deletes their messages and memberships, so the counters and cached
+        history of the rooms they were in are corrected, and each room they were a member of gets a new membership
+        version, as though they had left.
+        """
+        with transaction.atomic():
+            member_of = set(Room.members.through.objects.filter(user_id=self.id).values_list('room_id', flat=True))
+            posted_in = set(Message.objects.filter(user_id=self.id).values_list('room_id', flat=True).distinct())
+            result = super().delete(*args, **kwargs)
+
+            if not isinstance(result, HttpResponse):
+                if member_of:
+                    Room.objects.filter(id__in=member_of).update(member_version=F('member_version') + 1)
+                    CollectionVersion.bump(Room.ACTIVITY_VERSION)
+                Room.reconcile_counters(member_of | posted_in)
+
+        if not isinstance(result, HttpResponse):
+            for room_id in posted_in:
+                room_cache.invalidate_recent_messages(room_id)
+
+        return result
+
 
 class Room(ExtendedModel):
     """ A chat room. """
     name = models.CharField("room name", max_length=100, unique=True, default=None)
     members = models.ManyToManyField(User, blank=True)
+    member_version = models.PositiveIntegerField("membership version", default=0)
+    last_activity = models.DateTimeField("time of the newest message, or of creation", default=get_now)
+
+    versioned = True
+    ACTIVITY_VERSION = 'room-activity'
+
+    # Counters maintained as messages are posted and members join and leave, so they're read without counting rows.
+    # See reconcile_counters().  Every change to them bumps the ACTIVITY_VERSION collection version.
+    message_count = models.PositiveIntegerField("number of messages", default=0)
+    member_count = models.PositiveIntegerField("number of members", default=0)
+    last_message_id = models.IntegerField("ID of the newest message", null=True, blank=True)
 
     def white_list(self):
         """ Whitelist override
@@ -108,31 +245,465 @@ class Room(ExtendedModel):
             'name'
         ]
 
-    def member_data(self):
-        """ Return the member data as a json-serializable object. """
+    def delete(self, *args, **kwargs):
+        """ Delete this room, and forget anything cached about it. """
+        room_id = self.id
+        result = super().delete(*args, **kwargs)
+
+        room_cache.forget_room(room_id)
+        return result
+
+    def member_data(self, fields=None):
+        """ Return a snapshot of the member data as a json-serializable object, tagged with the membership version it
+        reflects.
+        :param fields: (optional) Sparse fieldset of the members, as returned by User.parse_fields()
+        """
+        # The version is read (with the room) before the member list, so any change that lands in between is also
+        # delivered as a delta with a later version, and applying it again is harmless.
         return {
-            "members": [member.to_data() for member in self.members.all()]
+            "members": list(User.data_values(self.members.all(), fields)),
+            "version": self.member_version
         }
 
-    def messages(self, since_msg=None, msg_count=50):
+    @staticmethod
+    def record_messages(room_id, count, newest_id, timestamp):
+        """ Count new messages, and move the room's newest message and last activity forward to them.  Must be called
+        in the transaction that writes the messages.
+        :param room_id: Unique ID of the room
+        :param count: Number of messages written
+        :param newest_id: ID of the newest message written
+        :param timestamp: Time of the newest message written
+        :return: True if the messages are now the room's newest, so that they sort after every message recorded
+                before them.  False if any of them was back-dated, or overtaken by a message recorded first.
+        """
+        room = Room.objects.filter(id=room_id)
+        message_count = F('message_count') + count
+
+        # Usually a single update.  History is ordered by (timestamp, ID), so a back-dated message, or one written
+        # concurrently that sorts after ours and was recorded first, only changes the count.
+        newer = room.filter(Q(last_message_id__isnull=True) | Q(last_activity__lt=timestamp) |
+                            Q(last_activity=timestamp, last_message_id__lt=newest_id))
+        appended = bool(newer.update(message_count=message_count, last_message_id=newest_id, last_activity=timestamp))
+        if not appended:
+            room.update(message_count=message_count)
+
+        CollectionVersion.bump(Room.ACTIVITY_VERSION)
+        return appended
+
+    @staticmethod
+    def recent_messages_recorded(room_id, appended):
+        """ Bring the cached newest page of a room's history up to date with messages that have been committed.
+        :param room_id: Unique ID of the room
+        :param appended: Result of record_messages()
+        """
+        if appended:
+            room_cache.recent_messages_appended(room_id)
+        else:
+            room_cache.invalidate_recent_messages(room_id)
+
+    @classmethod
+    def reconcile_counters(cls, room_ids=None, dry_run=False):
+        """ Recount the maintained counters of rooms from their messages and memberships, and correct any that have
+        drifted, e.g. because rows were written or deleted without going through the model.
+        :param room_ids: (optional) Rooms to reconcile.  Defaults to every room.
+        :param dry_run: If True, report drift without correcting it
+        :return: Dictionary mapping the ID of each room that had drifted to a dictionary of its corrected values
+        """
+        if room_ids is None:
+            room_ids = cls.objects.order_by('id').values_list('id', flat=True)
+
+        room_ids = sorted(room_ids)
+        names = ('message_count', 'member_count', 'last_message_id', 'last_activity')
+        drifted = {}
+
+        # A few queries for each chunk of rooms, with grouped counts of their messages and members.  Chunks are kept
+        # small enough that finding their newest messages stays within SQLite's limit of 999 query parameters.
+        for start in range(0, len(room_ids), 400):
+            rooms = cls.objects.filter(id__in=room_ids[start:start + 400]).values_list('id', *names)
+            chunk = {row[0]: dict(zip(names, row[1:])) for row in rooms}
+
+            messages = Message.objects.filter(room_id__in=chunk).values('room')
+            messages = {row["room"]: row for row in messages.annotate(count=Count('id'), last=Max('timestamp'))}
+
+            # The newest message is the one with the highest ID at the newest timestamp, as history is ordered
+            lasts = {row["last"] for row in messages.values()}
+            newest = Message.objects.filter(room_id__in=messages, timestamp__in=lasts)
+            for row in newest.values('room', 'timestamp').annotate(newest=Max('id')):
+                if row["timestamp"] == messages[row["room"]]["last"]:
+                    messages[row["room"]]["newest"] = row["newest"]
+
+            members = cls.members.through.objects.filter(room_id__in=chunk).values('room')
+            members = {row["room"]: row["count"] for row in members.annotate(count=Count('id'))}
+
+            for room_id, current in chunk.items():
+                stats = messages.get(room_id)
+                expected = dict(current, member_count=members.get(room_id, 0),
+                                message_count=stats["count"] if stats else 0,
+                                last_message_id=stats["newest"] if stats else None)
+
+                # Rooms without messages keep the time they were created
+                if stats:
+                    expected["last_activity"] = stats["last"]
+
+                corrections = {name: value for name, value in expected.items() if current[name] != value}
+
+                if corrections:
+                    drifted[room_id] = corrections
+
+                    if not dry_run:
+                        cls.objects.filter(id=room_id).update(**corrections)
+
+        if drifted and not dry_run:
+            CollectionVersion.bump(cls.ACTIVITY_VERSION)
+
+        return drifted
+
+    @classmethod
+    def add_activity(cls, items):
+        """ Add an activity summary to public representations of rooms: the newest message, and the number of
+        messages and members.  Costs two queries however many rooms there are.
+        :param items: List of room dictionaries, updated in place
+        """
+        room_ids = [item["id"] for item in items]
+        if not room_ids:
+            return
+
+        counters = cls.objects.filter(id__in=room_ids).values('id', 'message_count', 'member_count', 'last_message_id')
+        counters = {row["id"]: row for row in counters}
+
+        newest_ids = [row["last_message_id"] for row in counters.values() if row["last_message_id"] is not None]
+        newest = {msg["id"]: msg for msg in Message.rendered_values(Message.objects.filter(id__in=newest_ids))}
+
+        for item in items:
+            room = counters.get(item["id"], {})
+            item["message_count"] = room.get("message_count", 0)
+            item["member_count"] = room.get("member_count", 0)
+            item["last_message"] = newest.get(room.get("last_message_id"))
+
+    @classmethod
+    def activity_version(cls):
+        """ Validator for the activity of every room, which changes whenever a message is posted to, or a member
+        joins or leaves, any room.  A single lookup, as the counters bump it whenever they change.
+        """
+        return CollectionVersion.of(cls.ACTIVITY_VERSION)
+
+    @staticmethod
+    def member_version_of(room_id):
+        """ Read a room's membership version without loading the room.
+        :return: The version, or None if the room doesn't exist
+        """
+        return Room.objects.filter(id=room_id).values_list('member_version', flat=True).first()
+
+    @staticmethod
+    def message_version_of(room_id):
+        """ Read a validator for a room's history without loading the room.  The message count changes with every
+        message written, wherever it lands in the history, so back-dated messages change it too.
+        :return: (message count, newest message ID) tuple, or None if the room doesn't exist
+        """
+        return Room.objects.filter(id=room_id).values_list('message_count', 'last_message_id').first()
+
+    def add_member(self, user_id):
+        """ Add a user to this room.
+        :param user_id: Unique ID of the user
+        :return: The room's new membership version, or None if the user was already a member
+        """
+        try:
+            with transaction.atomic():
+                self._bump_member_version(1)
+
+                # A single insert, relying on the unique (room, user) constraint rather than checking first
+                self.members.through.objects.create(room_id=self.id, user_id=user_id)
+        except django.db.IntegrityError:
+            return None
+
+        return self.member_version
+
+    def remove_member(self, user_id):
+        """ Remove a user from this room.
+        :param user_id: Unique ID of the user
+        :return: The room's new membership version, or None if the user wasn't a member
+        """
+        with transaction.atomic():
+            membership = self.members.through.objects.filter(room_id=self.id, user_id=user_id)
+
+            # Locking the membership makes a concurrent removal of the same member wait for us, and then find nothing
+            # to remove, so the member count is only decremented once
+            if not membership.select_for_update().exists():
+                # Nothing changed, so clients' copies of the member list are still current
+                return None
+
+            self._bump_member_version(-1)
+            membership.delete()
+
+        return self.member_version
+
+    def _bump_member_version(self, member_change):
+        """ Increment the membership version, and adjust the member count.  Must be called inside a transaction; the
+        update holds the room's row lock until it commits, so concurrent membership changes in the same room are
+        numbered in commit order.
+        :param member_change: Change in the number of members
+        """
+        Room.objects.filter(id=self.id).update(member_version=F('member_version') + 1,
+                                               member_count=F('member_count') + member_change)
+        CollectionVersion.bump(Room.ACTIVITY_VERSION)
+        self.member_version = Room.objects.filter(id=self.id).values_list('member_version', flat=True)[0]
+
+    def add_messages(self, items):
+        """ Create a batch of messages in this room with a single insert.
+        :param items: List of dictionaries, each containing at least "user" and "msg"
+        :return: Public representations of the created messages, in the order given
+        :raises ValueError: If a message is incomplete or refers to an unknown user
+        """
+        try:
+            user_ids = [int(item["user"]) for item in items]
+            texts = [item["msg"] for item in items]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Every message requires a user and a msg")
+
+        # The batch is written with a single insert, so anything the database would refuse must be caught here
+        if not all(Message.valid_text(text) for text in texts):
+            raise ValueError("Every msg must be text of 1 to %d characters" % Message._meta.get_field('msg').max_length)
+
+        # Resolve every referenced user with one query
+        unknown_ids = set(user_ids) - set(User.objects.filter(id__in=set(user_ids)).values_list('id', flat=True))
+        if unknown_ids:
+            raise ValueError("Unknown users: %s" % ", ".join(str(user_id) for user_id in sorted(unknown_ids)))
+
+        # The whole batch shares one timestamp, and is ordered within it by ID
+        timestamp = get_now()
+        batch = [Message(room=self, user_id=user_id, msg=text, timestamp=timestamp)
+                 for user_id, text in zip(user_ids, texts)]
+
+        for msg in batch:
+            msg.render()
+
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+
+            if batch[0].id is None:
+                # Not every backend reports the IDs of bulk inserted rows, so read them back.  IDs are allocated in
+                # insertion order, so the newest rows stamped with our timestamp are ours.
+                created_ids = Message.objects.filter(room=self, timestamp=timestamp).order_by('-id')
+                created_ids = reversed(created_ids.values_list('id', flat=True)[:len(batch)])
+
+                for msg, msg_id in zip(batch, created_ids):
+                    msg.id = msg_id
+
+            appended = Room.record_messages(self.id, len(batch), batch[-1].id, timestamp)
+
+        Room.recent_messages_recorded(self.id, appended)
+        return [msg.to_data() for msg in batch]
+
+    def messages(self, before=None, after=None, msg_count=50, rendered=False, fields=None):
         """ Return set of messages from this room ordered by timestamp
-        :param since_msg: If specified, only get messages older than this message
+        :param before: If specified, a (timestamp, id) tuple.  Only messages older than this position are returned,
+                newest first.
+        :param after: If specified, a (timestamp, id) tuple.  Only messages newer than this position are returned,
+                oldest first, so that a client can catch up on what it missed.
         :param msg_count: If specified, return this number of messages (defaults to 50)
-        :return: JSON-serializable object with "messages" key
+        :param rendered: If True, return messages as RenderedMessage objects, read from their stored JSON instead of
+                being decoded into dictionaries
+        :param fields: (optional) Sparse fieldset, as returned by Message.parse_fields(), for dictionary results
+        :return: JSON-serializable object with "messages" key.  The "before" key holds a cursor for the next older
+                page, or None if there are no older messages.  The "after" key holds a cursor for the newest message
+                seen so far, to be used to catch up on newer messages later.
         """
-        if since_msg:
-            query_set = Message.objects.filter(timestamp__lt=since_msg.timestamp, room=self)
+        query_set = Message.objects.filter(room=self)
+
+        def read(page_query_set):
+            if rendered:
+                return Message.rendered_values(page_query_set)
+
+            return list(Message.data_values(page_query_set, fields))
+
+        # Keyset conditions equivalent to (timestamp, id) < before or (timestamp, id) > after.  The timestamp bound is
+        # stated on its own so the database can turn it into a range scan on the (room, timestamp, id) index.
+        if after:
+            timestamp, msg_id = after
+            query_set = query_set.filter(Q(timestamp__gt=timestamp) | Q(id__gt=msg_id), timestamp__gte=timestamp)
+            page = read(query_set.order_by('timestamp', 'id')[:msg_count])
+
+            # Keep the client's position if nothing new arrived
+            newest = (page[-1]["timestamp"], page[-1]["id"]) if page else after
+
+            return {
+                "messages": page,
+                "after": encode_message_cursor(*newest)
+            }
+
+        if before:
+            timestamp, msg_id = before
+            query_set = query_set.filter(Q(timestamp__lt=timestamp) | Q(id__lt=msg_id), timestamp__lte=timestamp)
+
+        # Fetch one extra row so we know whether an older page exists without issuing a count query
+        page = read(query_set.order_by('-timestamp', '-id')[:msg_count + 1])
+
+        if len(page) > msg_count:
+            page = page[:msg_count]
+            older_cursor = encode_message_cursor(page[-1]["timestamp"], page[-1]["id"])
         else:
-            query_set = Message.objects.filter(room=self)
+            older_cursor = None
+
+        return {
+            "messages": page,
+            "before": older_cursor,
+            "after": encode_message_cursor(page[0]["timestamp"], page[0]["id"]) if page else None
+        }
+
+    def newer_messages(self, page, msg_count=50):
+        """ Bring a newest page of this room's history, as returned by messages(), up to date by reading only the
+        messages that sort after everything in it.
+        :param page: Newest page, which must not be missing any message that sorts inside it
+        :param msg_count: Page size the page was read with
+        :return: Updated page, or None if so many messages are newer that the page should be read afresh
+        """
+        if not page["messages"]:
+            return None
+
+        newest = page["messages"][0]
+        newer = self.messages(after=(newest["timestamp"], newest["id"]), msg_count=msg_count, rendered=True)
+
+        if len(newer["messages"]) >= msg_count:
+            return None
+
+        messages = newer["messages"][::-1] + page["messages"]
+        before = page["before"]
+
+        if len(messages) > msg_count:
+            messages = messages[:msg_count]
+            before = encode_message_cursor(messages[-1]["timestamp"], messages[-1]["id"])
 
         return {
-            "messages": [item_obj.to_data() for item_obj in query_set.order_by('-timestamp')[:msg_count]]
+            "messages": messages,
+            "before": before,
+            "after": newer["after"]
         }
 
+    class Meta:
+        """ The room list can be ordered by recent activity, newest first. """
+        index_together = [
+            ('last_activity', 'id'),
+        ]
+
+
+def _render_fields(data):
+    """ Encode a message's public representation, less its ID, as JSON object members without the braces. """
+    return dumps({name: value for name, value in data.items() if name != "id"}).decode('utf-8')[1:-1]
+
+
+class RenderedMessage(RawJSON):
+    """ A message's public representation, encoded when the message was written.  Its ID and timestamp can be read
+    just like those of the dictionary form (as can its author's ID), so that paging and caching code handles both.
+    """
+    __slots__ = ('id', 'timestamp', 'user')
+
+    def __init__(self, msg_id, timestamp, user_id, rendered):
+        # Formatted as text and then encoded, as bytes only support % formatting from Python 3.5
+        super().__init__(('{"id":%d,%s}' % (msg_id, rendered)).encode('utf-8'))
+        self.id = msg_id
+        self.timestamp = timestamp
+        self.user = user_id
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
 
 class Message(ExtendedModel):
-    """ An individual message in a chat room. """
+    """ An individual message in a chat room.  Messages never change once written, so each one stores its own encoded
+    public representation (less the ID, which isn't known until the row is inserted) for history reads to reuse.
+    """
     room = models.ForeignKey(Room, blank=False)
     user = models.ForeignKey(User, blank=False)
     msg = models.CharField("message text", max_length=4000, blank=False, default=None)
     timestamp = models.DateTimeField("time message sent", default=get_now)
+    rendered = models.TextField("encoded public representation, without the ID", default='', editable=False)
+
+    # Paging cursors are built from the ID and timestamp
+    required_fields = ('id', 'timestamp')
+
+    def white_list(self):
+        """ Whitelist override
+        :return: List of fields to be included in API call responses.
+        """
+        return [
+            'id',
+            'room',
+            'user',
+            'msg',
+            'timestamp'
+        ]
+
+    @classmethod
+    def valid_text(cls, text):
+        """ Check message text as the database would, so that a bad message can be refused before it's written.
+        :return: True if text is a non-empty string that fits the msg column
+        """
+        return isinstance(text, str) and 0 < len(text) <= cls._meta.get_field('msg').max_length
+
+    def render(self):
+        """ Encode this message's public representation into the rendered field.  Called before the message is
+        written; bulk inserts must call it themselves.
+        """
+        self.rendered = _render_fields(self.to_data())
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        self.render()
+
+        # Without a savepoint of its own, like the insert itself, so that saving costs no more round trips inside an
+        # outer transaction
+        with transaction.atomic(savepoint=False):
+            result = super().save(*args, **kwargs)
+
+            if adding and not isinstance(result, HttpResponse):
+                appended = Room.record_messages(self.room_id, 1, self.id, self.timestamp)
+
+        if adding and not isinstance(result, HttpResponse):
+            Room.recent_messages_recorded(self.room_id, appended)
+
+        return result
+
+    @classmethod
+    def rendered_values(cls, query_set):
+        """ Read messages as RenderedMessage objects, without building model instances or encoding anything.
+        :param query_set: Query set of messages, which will be evaluated
+        :return: List of RenderedMessage
+        """
+        rows = list(query_set.values_list('id', 'timestamp', 'user_id', 'rendered'))
+        unrendered_ids = [msg_id for msg_id, timestamp, user_id, text in rows if not text]
+
+        if unrendered_ids:
+            # Messages written before rendering existed, or by code that bypassed it, are rendered (and stored) now
+            late_renders = {}
+
+            for msg in Message.objects.filter(id__in=unrendered_ids):
+                msg.render()
+                Message.objects.filter(id=msg.id).update(rendered=msg.rendered)
+                late_renders[msg.id] = msg.rendered
+
+            rows = [(msg_id, timestamp, user_id, text or late_renders[msg_id])
+                    for msg_id, timestamp, user_id, text in rows]
+
+        return [RenderedMessage(*row) for row in rows]
+
+    class Meta:
+        """ Room history is always read newest first, keyed on (timestamp, id). """
+        index_together = [
+            ('room', 'timestamp', 'id'),
+        ]
+
+
+class SlowQuery(models.Model):
+    """ Aggregate statistics, and the most recent plan, for one shape of slow database query.  See chat.slowqueries.
+    """
+    fingerprint = models.CharField("hash of the normalised SQL", max_length=40, unique=True)
+    normalized = models.TextField("SQL with literals and parameters replaced by placeholders")
+    example = models.TextField("SQL and parameters of the slowest occurrence")
+    plan = models.TextField("query plan of the slowest occurrence", blank=True)
+    count = models.PositiveIntegerField("number of slow occurrences", default=0)
+    total_time = models.FloatField("total seconds spent in slow occurrences", default=0, db_index=True)
+    max_time = models.FloatField("seconds taken by the slowest occurrence", default=0)
+    last_seen = models.DateTimeField("last slow occurrence", default=get_now)
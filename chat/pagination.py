@@ -0,0 +1,145 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from datetime import datetime
+
+from django.db.models import Q
+
+from .codec import dumps
+
+
+CURSOR_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _encode(raw):
+    """ Wrap a raw cursor string so that clients treat it as opaque. """
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode(cursor):
+    """ Unwrap a cursor produced by _encode.  Raises ValueError if the cursor is malformed. """
+    try:
+        # Restore the padding stripped by _encode
+        return urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii')).decode('utf-8')
+    except (BinasciiError, UnicodeError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def encode_message_cursor(timestamp, msg_id):
+    """ Build an opaque cursor pointing at a message's position in a room's history.
+    :param timestamp: Timestamp of the message
+    :param msg_id: Unique ID of the message, used to break ties between messages sharing a timestamp
+    :return: URL-safe cursor string
+    """
+    return _encode("%s|%d" % (timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), msg_id))
+
+
+def decode_message_cursor(cursor):
+    """ Decode a cursor produced by encode_message_cursor.
+    :param cursor: Cursor string received from a client
+    :return: (timestamp, msg_id) tuple
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        timestamp, msg_id = _decode(cursor).split('|')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(msg_id)
+    except ValueError:
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def encode_id_cursor(item_id):
+    """ Build an opaque cursor pointing at an item in a collection ordered by ID. """
+    return _encode("id|%d" % item_id)
+
+
+def decode_id_cursor(cursor):
+    """ Decode a cursor produced by encode_id_cursor.
+    :param cursor: Cursor string received from a client
+    :return: ID of the last item the client has seen
+    :raises ValueError: If the cursor is malformed
+    """
+    try:
+        prefix, item_id = _decode(cursor).split('|')
+
+        if prefix != "id":
+            raise ValueError(prefix)
+
+        return int(item_id)
+    except ValueError:
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def paginate_by_id(query_set, limit, cursor=None):
+    """ Read one page of a collection, ordered by ID.
+    :param query_set: Values query set to page through
+    :param limit: Maximum number of items to return
+    :param cursor: (optional) Cursor returned with the previous page
+    :return: (items, next cursor) tuple.  The next cursor is None once the collection is exhausted.
+    """
+    if cursor:
+        query_set = query_set.filter(id__gt=decode_id_cursor(cursor))
+
+    # Fetch one extra row so we know whether another page exists without issuing a count query
+    items = list(query_set.order_by('id')[:limit + 1])
+
+    if len(items) > limit:
+        items = items[:limit]
+        return items, encode_id_cursor(items[-1]["id"])
+
+    return items, None
+
+
+def paginate_by_recency(query_set, field, limit, cursor=None):
+    """ Read one page of a collection, ordered newest first by a timestamp field, with ties broken by ID.
+    :param query_set: Values query set to page through, which must include the field
+    :param field: Name of the timestamp field
+    :param limit: Maximum number of items to return
+    :param cursor: (optional) Cursor returned with the previous page
+    :return: (items, next cursor) tuple.  The next cursor is None once the collection is exhausted.
+    """
+    if cursor:
+        # Keyset condition equivalent to (field, id) < cursor, with the timestamp bound stated on its own so that it
+        # can be turned into a range scan on a (field, id) index
+        timestamp, item_id = decode_message_cursor(cursor)
+        query_set = query_set.filter(Q(**{field + '__lt': timestamp}) | Q(id__lt=item_id),
+                                     **{field + '__lte': timestamp})
+
+    # Fetch one extra row so we know whether another page exists without issuing a count query
+    items = list(query_set.order_by('-' + field, '-id')[:limit + 1])
+
+    if len(items) > limit:
+        items = items[:limit]
+        return items, encode_message_cursor(items[-1][field], items[-1]["id"])
+
+    return items, None
+
+
+def stream_by_id(collection_name, query_set, chunk_size):
+    """ Encode an entire collection as a JSON object, one chunk at a time.
+
+    Chunks are read with the same keyset condition used by paginate_by_id, so each chunk is an index range scan and
+    only one chunk is ever held in memory.  Chunks are only read as the response is sent, after the view has returned,
+    each in its own statement, so the stream isn't a snapshot: an object changed while the collection is being sent
+    appears as it was when its chunk was read.
+    :param collection_name: Key under which the list of items is nested
+    :param query_set: Values query set to encode
+    :param chunk_size: Number of rows read from the database per query
+    :return: Generator of encoded JSON fragments
+    """
+    yield b'{' + dumps(collection_name) + b':['
+
+    last_id = None
+    separator = b''
+
+    while True:
+        chunk_query_set = query_set if last_id is None else query_set.filter(id__gt=last_id)
+        chunk = list(chunk_query_set.order_by('id')[:chunk_size])
+
+        if chunk:
+            yield separator + b','.join(dumps(item) for item in chunk)
+            separator = b','
+            last_id = chunk[-1]["id"]
+
+        if len(chunk) < chunk_size:
+            break
+
+    yield b']}'
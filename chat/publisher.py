@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+
+from django.conf import settings
+
+from . import metrics
+from .realtime import get_realtime_backend
+
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher(object):
+    """ Hands stream events to a background worker so that publishing never holds up a request.
+
+    The worker collects events for a short window, concatenates the events queued for each stream and publishes them
+    with one proxy call per stream.  The queue is bounded: when the worker can't keep up, publishers wait briefly for
+    space and then drop the event, which is counted in the stats.
+    """
+
+    def __init__(self, publish_func, window=0.05, queue_size=10000, put_timeout=0.01):
+        """
+        :param publish_func: Function called as publish_func(stream, event_text) to send a batch of events
+        :param window: Seconds the worker waits for more events before publishing what it has collected
+        :param queue_size: Maximum number of events waiting to be published
+        :param put_timeout: Seconds a publisher waits for space in a full queue before dropping the event
+        """
+        self._publish_func = publish_func
+        self._window = window
+        self._put_timeout = put_timeout
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stats = {
+            "enqueued": 0,
+            "dropped": 0,
+            "published": 0,
+            "publish_calls": 0,
+            "publish_errors": 0,
+            "max_queue_depth": 0,
+        }
+
+    def publish(self, stream, event_text):
+        """ Queue an event for publishing.
+        :param stream: Stream name
+        :param event_text: Formatted server-sent event text
+        :return: False if the event was dropped because the queue is full
+        """
+        self._ensure_worker()
+
+        try:
+            self._queue.put((stream, event_text), timeout=self._put_timeout)
+        except Full:
+            self._count("dropped")
+            logger.warning("Publish queue full, dropped event for %s", stream)
+            return False
+
+        with self._lock:
+            self._stats["enqueued"] += 1
+            self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], self._queue.qsize())
+
+        return True
+
+    def stats(self):
+        """ Return a snapshot of the publishing counters, including the current queue depth. """
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats["queue_depth"] = self._queue.qsize()
+        return stats
+
+    def flush(self, timeout=None):
+        """ Wait until every queued event has been published.  Mostly useful for tests and shutdown. """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.001)
+
+        return True
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _ensure_worker(self):
+        """ Start the worker thread on first use, which also gives each forked server process its own worker. """
+        if self._worker is None or not self._worker.is_alive():
+            with self._lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="chat-publisher")
+                    self._worker.daemon = True
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            # Wait for the first event, then keep collecting until the window closes
+            batch = [self._queue.get()]
+            deadline = time.time() + self._window
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            # Coalesce the events per stream, keeping them in the order they were published
+            streams = OrderedDict()
+            for stream, event_text in batch:
+                streams.setdefault(stream, []).append(event_text)
+
+            for stream, event_texts in streams.items():
+                start = time.perf_counter()
+                try:
+                    self._publish_func(stream, ''.join(event_texts))
+                    self._count("published", len(event_texts))
+                except Exception:
+                    self._count("publish_errors")
+                    logger.exception("Failed to publish %d events to %s", len(event_texts), stream)
+
+                metrics.observe("chat_publish_seconds", time.perf_counter() - start)
+
+                self._count("publish_calls")
+
+            for _ in batch:
+                self._queue.task_done()
+
+
+class SyncPublisher(object):
+    """ Publishes each event from the calling thread.  Used when background publishing is turned off. """
+
+    def __init__(self, publish_func):
+        self._publish_func = publish_func
+
+    def publish(self, stream, event_text):
+        start = time.perf_counter()
+        self._publish_func(stream, event_text)
+        metrics.observe("chat_publish_seconds", time.perf_counter() - start)
+        return True
+
+    def stats(self):
+        return {}
+
+    def flush(self, timeout=None):
+        return True
+
+
+_publisher = None
+
+
+def get_publisher():
+    """ Return the process-wide publisher, configured from settings, which publishes to the realtime backend. """
+    global _publisher
+
+    if _publisher is None:
+        publish_func = get_realtime_backend().publish
+
+        if getattr(settings, 'CHAT_PUBLISH_ASYNC', True):
+            _publisher = Publisher(publish_func, window=getattr(settings, 'CHAT_PUBLISH_WINDOW', 0.05),
+                                   queue_size=getattr(settings, 'CHAT_PUBLISH_QUEUE_SIZE', 10000),
+                                   put_timeout=getattr(settings, 'CHAT_PUBLISH_PUT_TIMEOUT', 0.01))
+        else:
+            _publisher = SyncPublisher(publish_func)
+
+    return _publisher
@@ -0,0 +1,224 @@
+""" Realtime backends, which hold subscribers' event streams and deliver published events to them.
+
+The GRIP backend hands streams to an external GRIP proxy (e.g. Pushpin or Fanout), which holds the connections.  The
+hub backend holds them in this process instead, so that realtime delivery can be developed, tested and benchmarked
+without a proxy.  Each hub subscriber occupies a server thread (or greenlet) for as long as it is connected, and only
+receives events published by the same process, so the hub suits development, CI and single process deployments.
+"""
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.module_loading import import_string
+from django_grip import set_hold_stream
+from gripcontrol import HttpStreamFormat
+import django_grip
+
+from . import metrics
+
+
+class GripBackend(object):
+    """ Delivers events through an external GRIP proxy. """
+
+    def subscribe(self, request, stream, replay=None):
+        """ Start an event stream for a subscriber.
+        :param request: Request asking for the event stream
+        :param stream: Stream name
+        :param replay: (optional) Function returning the events the subscriber missed, as a list of (event ID, event
+                text) pairs, to be sent before any published events
+        :return: Response to return from the view
+        """
+        initial_text = ''.join(event_text for event_id, event_text in replay()) if replay else ''
+
+        # The proxy only holds the stream once this response reaches it, so events published while the replay is
+        # read can't be caught here.  Clients that see a gap in the event IDs reconnect with Last-Event-ID.
+        set_hold_stream(request, stream)
+        return HttpResponse(initial_text, content_type='text/event-stream')
+
+    def publish(self, stream, event_text):
+        """ Publish already formatted event text to a stream, waiting for the proxy to accept it. """
+        django_grip.publish(stream, [HttpStreamFormat(event_text)], blocking=True)
+
+    def stats(self):
+        return {}
+
+
+class _Subscriber(object):
+    """ One connected event stream, iterated by the server as the response body. """
+
+    def __init__(self, hub, stream, max_buffer, keepalive):
+        self.dropped = False
+        self._hub = hub
+        self._stream = stream
+        self._initial_text = None
+        self._replayed_ids = set()
+        self._keepalive = keepalive
+        self._buffer = Queue(maxsize=max_buffer)
+
+    def replay(self, events):
+        """ Send the events the subscriber missed before anything published.  Published events that were buffered
+        while the replay was being read, and that it already contains, are skipped.
+        :param events: List of (event ID, event text) pairs
+        """
+        self._initial_text = ''.join(event_text for event_id, event_text in events)
+        self._replayed_ids = {event_id for event_id, event_text in events if event_id is not None}
+
+    def _unreplayed(self, event_text):
+        """ Drop the events already sent by the replay from published event text, which may hold several events. """
+        frames = [frame for frame in event_text.split('\n\n') if frame]
+        fresh = [frame for frame in frames if not frame.startswith('id: ') or
+                 frame.split('\n', 1)[0][len('id: '):] not in self._replayed_ids]
+
+        if len(fresh) == len(frames):
+            # Published events are in order, so once one is new, none of the rest can have been replayed
+            self._replayed_ids = set()
+            return event_text
+
+        return ''.join(frame + '\n\n' for frame in fresh)
+
+    def offer(self, published, event_text):
+        """ Buffer an event for delivery.
+        :return: False if the buffer is full
+        """
+        try:
+            self._buffer.put_nowait((published, event_text))
+            return True
+        except Full:
+            return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._initial_text:
+            initial_text, self._initial_text = self._initial_text, None
+            return initial_text
+
+        # A consumer too slow to keep up is disconnected, and will catch up with Last-Event-ID when it reconnects
+        if self.dropped:
+            raise StopIteration
+
+        while True:
+            try:
+                published, event_text = self._buffer.get(timeout=self._keepalive)
+            except Empty:
+                # A comment line keeps idle connections open through proxies, and lets us notice disconnected clients
+                return ':\n\n'
+
+            metrics.observe("chat_fanout_seconds", time.perf_counter() - published)
+
+            if self._replayed_ids:
+                event_text = self._unreplayed(event_text)
+
+            if event_text:
+                return event_text
+
+    def close(self):
+        """ Called by the server once the response is finished, including when the client disconnects. """
+        self._hub.unsubscribe(self._stream, self)
+
+
+class HubBackend(object):
+    """ Holds event streams in this process and fans published events out to them from memory.
+
+    Every subscriber has its own bounded buffer.  A subscriber whose buffer is full when an event is published is
+    dropped rather than allowed to hold up delivery, or memory, for everyone else.
+    """
+
+    def __init__(self, max_buffer=100, keepalive=15, max_subscribers=1000):
+        """
+        :param max_buffer: Events buffered per subscriber before it is dropped
+        :param keepalive: Seconds between keepalive comments on idle streams
+        :param max_subscribers: Maximum number of connected subscribers; further subscribers are turned away with 503
+        """
+        self._max_buffer = max_buffer
+        self._keepalive = keepalive
+        self._max_subscribers = max_subscribers
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "subscribes": 0,
+            "rejected": 0,
+            "published": 0,
+            "delivered": 0,
+            "dropped": 0,
+        }
+
+    def subscribe(self, request, stream, replay=None):
+        subscriber = _Subscriber(self, stream, self._max_buffer, self._keepalive)
+
+        # Register before reading the replay, so that anything published meanwhile is buffered rather than missed
+        with self._lock:
+            if self._max_subscribers is not None and self._subscriber_count() >= self._max_subscribers:
+                self._stats["rejected"] += 1
+                return HttpResponse("Too many subscribers", status=503)
+
+            self._streams.setdefault(stream, set()).add(subscriber)
+            self._stats["subscribes"] += 1
+
+        if replay:
+            try:
+                subscriber.replay(replay())
+            except BaseException:
+                self.unsubscribe(stream, subscriber)
+                raise
+
+        response = StreamingHttpResponse(subscriber, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def unsubscribe(self, stream, subscriber):
+        with self._lock:
+            subscribers = self._streams.get(stream)
+
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._streams[stream]
+
+    def publish(self, stream, event_text):
+        published = time.perf_counter()
+
+        with self._lock:
+            subscribers = list(self._streams.get(stream, ()))
+            self._stats["published"] += 1
+
+        dropped = [subscriber for subscriber in subscribers if not subscriber.offer(published, event_text)]
+
+        for subscriber in dropped:
+            subscriber.dropped = True
+            self.unsubscribe(stream, subscriber)
+
+        with self._lock:
+            self._stats["delivered"] += len(subscribers) - len(dropped)
+            self._stats["dropped"] += len(dropped)
+
+    def stats(self):
+        """ Return a snapshot of the hub's counters, including the current number of streams and subscribers. """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["streams"] = len(self._streams)
+            stats["subscribers"] = self._subscriber_count()
+
+        return stats
+
+    def _subscriber_count(self):
+        return sum(len(subscribers) for subscribers in self._streams.values())
+
+
+_realtime_backend = None
+
+
+def get_realtime_backend():
+    """ Return the process-wide realtime backend, configured by the CHAT_REALTIME_BACKEND setting. """
+    global _realtime_backend
+
+    if _realtime_backend is None:
+        config = getattr(settings, 'CHAT_REALTIME_BACKEND', {})
+        backend_class = import_string(config.get('BACKEND', 'chat.realtime.GripBackend'))
+        _realtime_backend = backend_class(**config.get('OPTIONS', {}))
+
+    return _realtime_backend
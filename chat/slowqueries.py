@@ -0,0 +1,154 @@
+""" Slow query capture.
+
+Queries slower than CHAT_SLOW_QUERY_THRESHOLD seconds are grouped by fingerprint (their SQL with every literal and
+parameter replaced by a placeholder) and recorded in the SlowQuery table along with the plan of the slowest
+occurrence, so that every server process contributes to the same report.  Only the CHAT_SLOW_QUERY_MAX_ENTRIES
+fingerprints with the most total time are kept.  The report is printed by the slow_queries management command.
+"""
+import logging
+import re
+import threading
+from hashlib import sha1
+
+import django.db
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from . import instrumentation, metrics
+from .models import SlowQuery, get_now
+
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+# Most slow queries held for recording at once, per thread
+MAX_PENDING = 100
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+def fingerprint(sql):
+    """ Normalise SQL so that queries differing only in their literals and parameters look the same.
+    :return: Tuple of (hash, normalised SQL)
+    """
+    normalized = _PLACEHOLDER.sub('?', _NUMBER.sub('?', _STRING.sub('?', sql)))
+    normalized = _WHITESPACE.sub(' ', _LIST.sub('(...)', normalized)).strip()
+    return sha1(normalized.encode('utf-8')).hexdigest(), normalized
+
+
+def explain(connection, sql, params, analyze=False):
+    """ Ask the database for a query's plan.  Only SELECT statements are explained, so that EXPLAIN ANALYZE never
+    repeats a write.
+    :param connection: Connection the query ran on
+    :param analyze: Run the query again to collect actual row counts and timings (PostgreSQL only)
+    :return: The plan as text, or an empty string if the query can't be explained
+    """
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return ''
+
+    if connection.vendor == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+    elif connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    try:
+        # A savepoint, so that a failed EXPLAIN doesn't abort the transaction of the request being watched
+        with transaction.atomic(using=connection.alias):
+            cursor = connection.cursor()
+            cursor.execute(prefix + sql, params)
+            rows = cursor.fetchall()
+    except django.db.Error as ex:
+        return "EXPLAIN failed: %s" % ex
+
+    return '\n'.join(' '.join(str(column) for column in row) for row in rows)
+
+
+def record(connection, sql, params, elapsed):
+    """ Record a slow query, explaining it if it's the slowest of its kind so far.  Called by flush(). """
+    key, normalized = fingerprint(sql)
+    analyze = getattr(settings, 'CHAT_SLOW_QUERY_ANALYZE', False)
+    example = "%s -- params: %r" % (sql, params)
+
+    with transaction.atomic(using=connection.alias):
+        entry = SlowQuery.objects.using(connection.alias).select_for_update().filter(fingerprint=key).first()
+
+        if entry is None:
+            SlowQuery.objects.using(connection.alias).create(
+                fingerprint=key, normalized=normalized, example=example, count=1, total_time=elapsed,
+                max_time=elapsed, plan=explain(connection, sql, params, analyze))
+            _trim(connection)
+            return
+
+        changes = {"count": F('count') + 1, "total_time": F('total_time') + elapsed, "last_seen": get_now()}
+
+        if elapsed > entry.max_time:
+            changes.update(max_time=elapsed, example=example, plan=explain(connection, sql, params, analyze))
+
+        SlowQuery.objects.using(connection.alias).filter(id=entry.id).update(**changes)
+
+
+def _trim(connection):
+    """ Keep only the fingerprints with the most total time. """
+    max_entries = getattr(settings, 'CHAT_SLOW_QUERY_MAX_ENTRIES', 100)
+    query_set = SlowQuery.objects.using(connection.alias)
+    excess = list(query_set.order_by('-total_time').values_list('id', flat=True)[max_entries:])
+
+    if excess:
+        query_set.filter(id__in=excess).delete()
+
+
+def _hold(connection, sql, params, elapsed):
+    """ Hook holding on to every query slower than the threshold until flush() records it. """
+    # The recorder's own queries, including the EXPLAIN, are never recorded
+    if elapsed >= _local.threshold and not getattr(_local, 'recording', False):
+        pending = _pending()
+        if len(pending) < MAX_PENDING:
+            pending.append((connection, sql, params, elapsed))
+
+
+def _pending():
+    if getattr(_local, 'pending', None) is None:
+        _local.pending = []
+
+    return _local.pending
+
+
+def flush():
+    """ Record the slow queries this thread has seen since the last flush.  Queries are recorded after the fact,
+    outside whatever transaction they ran in, so that explaining and recording them can't disturb the caller.  Nor
+    are they counted in the metrics of the request being finished.
+    """
+    pending, _local.pending = _pending(), []
+    _local.recording = True
+
+    try:
+        with metrics.paused():
+            for connection, sql, params, elapsed in pending:
+                try:
+                    record(connection, sql, params, elapsed)
+                except django.db.Error:
+                    # Recording must never break the request whose query was slow
+                    logger.exception("Failed to record slow query")
+    finally:
+        _local.recording = False
+
+
+def watch(threshold):
+    """ Hold on to the slow queries this thread runs on instrumented connections (see chat.instrumentation), until
+    unwatch() is called.  Safe to call repeatedly.
+    :param threshold: Seconds a query must take to be recorded
+    """
+    _local.threshold = threshold
+    instrumentation.add_hook(_hold)
+
+
+def unwatch():
+    """ Stop holding on to this thread's slow queries.  Any already held are still recorded by flush(). """
+    instrumentation.remove_hook(_hold)
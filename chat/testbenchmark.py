@@ -0,0 +1,115 @@
+from unittest.mock import patch
+from django.test import TestCase, Client
+from django.core.cache import cache
+from . import benchmark, datasets
+from .cache import get_recent_backend
+from .models import Message, Room, User
+from .views import UserView
+
+
+class BenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        get_recent_backend().clear()
+
+    def test_run(self):
+
+        # Run every scenario once against a tiny dataset
+        results = benchmark.run({"users": 3, "rooms": 2, "members_per_room": 2, "messages_per_room": 60},
+                                iterations=1, warmup=0)
+
+        # Verify that every scenario reported its measurements
+        for name, result in results["scenarios"].items():
+            self.assertGreater(result["requests_per_second"], 0, name)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"], name)
+
+    def test_stream_measured(self):
+        User.objects.bulk_create(User(nick="stream-%d" % i, avatar="http://example.com/%d.png" % i) for i in range(5))
+
+        # Verify that the queries of a streamed response are counted, which only happens while it is read
+        with patch.object(UserView, '_stream_chunk_size', 2):
+            result = benchmark.run_scenario(Client(), lambda client: client.get("/api/users/", {"stream": 1}),
+                                            iterations=1, warmup=0)
+        self.assertEqual(4, result["max_queries"])
+
+    def test_compare(self):
+        baseline = {"scenarios": {"users_list": {"max_queries": 2, "p95_ms": 10.0}}}
+        current = {"scenarios": {"users_list": {"max_queries": 3, "p95_ms": 11.0}}}
+
+        # Verify that more queries count as a regression, but a small latency change doesn't
+        self.assertEqual(["users_list"], [name for name, message in benchmark.compare(baseline, current)])
+
+
+class QueryBudgetTestCase(TestCase):
+    """ Runs every endpoint against a small and a larger dataset, so that queries that scale with the data (N+1
+    patterns) fail the build.
+    """
+
+    def setUp(self):
+        get_recent_backend().clear()
+
+    def _query_counts(self, dataset):
+        results = benchmark.run(dataset, iterations=2, warmup=1)
+
+        # Verify that every scenario stayed within its budget
+        self.assertEqual([], benchmark.check_budgets(results))
+
+        # Start the next dataset from an empty database
+        Message.objects.all().delete()
+        Room.objects.all().delete()
+        User.objects.all().delete()
+        get_recent_backend().clear()
+        cache.clear()
+
+        return {name: result["max_queries"] for name, result in results["scenarios"].items()}
+
+    def test_budgets(self):
+        small = self._query_counts({"users": 6, "rooms": 2, "members_per_room": 3, "messages_per_room": 60})
+        large = self._query_counts({"users": 150, "rooms": 3, "members_per_room": 120, "messages_per_room": 180})
+
+        # Verify that no endpoint needs more queries as the data grows
+        self.assertEqual(small, large)
+
+    def test_check_budgets(self):
+        results = {"scenarios": {"users_list": {"max_queries": 3}, "unknown": {"max_queries": 0}}}
+
+        # Verify that going over budget, and having no budget at all, are both reported
+        self.assertEqual(["unknown", "users_list"],
+                         [name for name, message in benchmark.check_budgets(results, {"users_list": 2})])
+
+
+class DatasetTestCase(TestCase):
+
+    def test_generate(self):
+        dataset = datasets.generate(users=20, rooms=3, messages=100, max_members=10, skew=1.0, chunk_size=7)
+
+        # Verify that the most popular room got the most members and messages, and every message was written
+        room_ids = dataset["rooms"]
+        self.assertEqual(10, len(dataset["members"][room_ids[0]]))
+        self.assertGreater(Message.objects.filter(room_id=room_ids[0]).count(),
+                           Message.objects.filter(room_id=room_ids[-1]).count())
+        self.assertEqual(100, Message.objects.count())
+
+        # Verify that every message was written by a member of its room
+        for room_id in room_ids:
+            authors = set(Message.objects.filter(room_id=room_id).values_list('user_id', flat=True))
+            self.assertTrue(authors.issubset(dataset["members"][room_id]))
+
+    def test_same_seed_same_dataset(self):
+        first = datasets.generate(users=20, rooms=3, messages=30, max_members=10, seed=7, prefix="a")
+        second = datasets.generate(users=20, rooms=3, messages=30, max_members=10, seed=7, prefix="b")
+
+        # Verify that the memberships were chosen identically, relative to each dataset's users
+        def relative_members(dataset):
+            return [sorted(dataset["users"].index(user_id) for user_id in dataset["members"][room_id])
+                    for room_id in dataset["rooms"]]
+
+        self.assertEqual(relative_members(first), relative_members(second))
+
+    def test_prefix_taken(self):
+        datasets.generate(users=5, rooms=1, messages=5, max_members=2, prefix="taken")
+
+        # Verify that reusing a prefix is refused before anything is written
+        with self.assertRaises(ValueError):
+            datasets.generate(users=5, rooms=1, messages=5, max_members=2, prefix="taken")
+        self.assertEqual(5, User.objects.count())
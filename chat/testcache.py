@@ -0,0 +1,62 @@
+from django.test import SimpleTestCase
+from .cache import (LocalLRUBackend, get_recent_backend, get_recent_messages, invalidate_recent_messages,
+                    recent_messages_appended, recent_messages_version, set_recent_messages)
+
+
+class LocalLRUBackendTestCase(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        backend = LocalLRUBackend(max_entries=2)
+        backend.set("a", 1)
+        backend.set("b", 2)
+
+        # Touch "a" so that "b" becomes the least recently used entry
+        backend.get("a")
+        backend.set("c", 3)
+
+        self.assertEqual(1, backend.get("a"))
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(3, backend.get("c"))
+
+    def test_timeout(self):
+        backend = LocalLRUBackend(timeout=-1)
+        backend.set("a", 1)
+
+        # Verify that an expired entry is not served
+        self.assertIsNone(backend.get("a"))
+
+
+class RecentMessagesTestCase(SimpleTestCase):
+
+    def setUp(self):
+        get_recent_backend().clear()
+
+    def test_invalidated_by_new_messages(self):
+        set_recent_messages(1, {"messages": [], "before": None, "after": None}, recent_messages_version(1))
+        self.assertIsNotNone(get_recent_messages(1))
+
+        invalidate_recent_messages(1)
+        self.assertIsNone(get_recent_messages(1))
+
+    def test_appended_messages_merged(self):
+        set_recent_messages(1, {"messages": [], "before": None, "after": None}, recent_messages_version(1))
+        recent_messages_appended(1)
+
+        # Verify that the page is only handed out to be merged with the appended messages
+        self.assertIsNone(get_recent_messages(1))
+        self.assertIsNotNone(get_recent_messages(1, appended=True))
+
+        # Verify that a page invalidated since isn't handed out at all
+        invalidate_recent_messages(1)
+        self.assertIsNone(get_recent_messages(1, appended=True))
+
+    def test_slow_reader_doesnt_cache_stale_page(self):
+        # A reader misses the cache and starts reading the page from the database
+        version = recent_messages_version(1)
+
+        # Meanwhile a message is posted, which finds no page to invalidate
+        invalidate_recent_messages(1)
+
+        # Verify that the page the reader read before the post is never served
+        set_recent_messages(1, {"messages": [], "before": None, "after": None}, version)
+        self.assertIsNone(get_recent_messages(1))
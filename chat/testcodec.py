@@ -0,0 +1,40 @@
+from datetime import datetime, date, time
+from decimal import Decimal
+from json import loads, dumps
+from django.test import SimpleTestCase
+from django.core.serializers.json import DjangoJSONEncoder
+from . import codec
+from .codec import RawJSON
+
+
+class CodecTestCase(SimpleTestCase):
+
+    def test_matches_django_encoder(self):
+        data = {
+            "timestamp": datetime(2015, 2, 17, 8, 58, 1, 123456),
+            "whole_second": datetime(2015, 2, 17, 8, 58, 1),
+            "day": date(2015, 2, 17),
+            "time": time(8, 58, 1, 500),
+            "amount": Decimal("1.50"),
+            "nick": "café",
+        }
+
+        # Verify that values decode to exactly what the Django encoder produced
+        self.assertEqual(loads(dumps(data, cls=DjangoJSONEncoder)), loads(codec.dumps(data).decode('utf-8')))
+
+    def test_raw_json_spliced(self):
+        fragment = RawJSON(b'{"id":1,"msg":"already encoded"}')
+
+        # Verify that raw fragments are inserted as they are, wherever they appear
+        self.assertEqual(b'{"messages":[{"id":1,"msg":"already encoded"},2],"before":null}',
+                         codec.dumps({"messages": [fragment, 2], "before": None}))
+
+    def test_placeholder_lookalikes_untouched(self):
+        lookalike = "\x00deadbeef:0\x00"
+
+        # Verify that strings resembling a placeholder survive alongside real fragments
+        self.assertEqual([lookalike, {"a": 1}], codec.loads(codec.dumps([lookalike, RawJSON('{"a":1}')])))
+
+    def test_loads(self):
+        self.assertEqual({"msg": "hi"}, codec.loads(b'{"msg": "hi"}'))
+        self.assertRaises(ValueError, codec.loads, b'{"msg":')
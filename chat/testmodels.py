@@ -1,6 +1,12 @@
+from datetime import timedelta
 from django.test import TestCase
+from django.core.cache import cache
+from .cache import get_recent_backend
 from django.http import HttpResponse
-from .models import User, Room, ExtendedModel
+from .models import User, Room, Message, ExtendedModel, get_now
+from .pagination import decode_message_cursor
+from . import cache as room_cache
+from . import codec
 
 
 class ExtendedModelTestCase(TestCase):
@@ -18,12 +24,26 @@ class ExtendedModelTestCase(TestCase):
         # Get the test user
         test_user = User.objects.get(nick=self.TEST_USER_NICK)
 
-        # Verify that the test user does NOT override the white_list method.  If it does, find a new example model and
-        # update this test please.
-        self.assertEqual(test_user.white_list.__func__, ExtendedModel.white_list)
+        # Every model overrides the white_list method, so call the default implementation directly, and verify that it
+        # returns ALL fields from the user object
+        self.assertEqual([field.name for field in User._meta.fields], ExtendedModel.white_list(test_user))
+
+        # Verify that the user's own whitelist leaves out its bookkeeping
+        self.assertEqual({"id", "nick", "avatar", "last_seen"}, set(test_user.to_data().keys()))
+
+    def test_collection_version(self):
+
+        # Verify that the validator is a single lookup, and that every write through the model changes it
+        with self.assertNumQueries(1):
+            version = User.collection_version()
 
-        # Verify that the test user whitelist returns ALL fields from the user object, the default behavior
-        self.assertEqual(set(test_user.white_list()), set(test_user.to_data().keys()))
+        test_user = User.objects.get(nick=self.TEST_USER_NICK)
+        test_user.save()
+        self.assertNotEqual(version, User.collection_version())
+
+        version = User.collection_version()
+        test_user.delete()
+        self.assertNotEqual(version, User.collection_version())
 
     def test_whitelist(self):
 
@@ -37,6 +57,24 @@ class ExtendedModelTestCase(TestCase):
         # Verify that the test room ONLY returns the fields from our white list, nothing more, nothing less.
         self.assertEqual(set(test_room.white_list()), set(test_room.to_data().keys()))
 
+    def test_to_data_without_queries(self):
+
+        # Get the test room
+        test_room = Room.objects.get(name=self.TEST_ROOM_NAME)
+
+        # Verify that serializing the room doesn't touch its member list, or the database at all
+        with self.assertNumQueries(0):
+            test_room.to_data()
+
+    def test_data_values(self):
+
+        # Verify that reading public representations directly from the database gives the same result as serializing
+        # model instances, in a single query
+        with self.assertNumQueries(1):
+            room_values = list(Room.data_values())
+
+        self.assertEqual([room.to_data() for room in Room.objects.all()], room_values)
+
     def test_update_by_keyword(self):
 
         # Get the test user
@@ -74,3 +112,161 @@ class ExtendedModelTestCase(TestCase):
         result = test_user.delete()
 
         self.assertIsInstance(result, HttpResponse)
+
+
+class RoomMessagesTestCase(TestCase):
+
+    def setUp(self):
+        self.test_room = Room.objects.create(name="Enterprise")
+        self.test_user = User.objects.create(nick="Picard", avatar="http://example.com")
+
+    def test_keyset_paging_with_timestamp_ties(self):
+
+        # Create several messages that all share the same timestamp
+        timestamp = get_now()
+        created_ids = [Message.objects.create(room=self.test_room, user=self.test_user, msg=str(index),
+                                              timestamp=timestamp).id for index in range(5)]
+
+        # Page through the history two messages at a time
+        seen_ids = []
+        before = None
+        while True:
+            page = self.test_room.messages(before=before, msg_count=2)
+            seen_ids += [msg["id"] for msg in page["messages"]]
+
+            if page["before"] is None:
+                break
+
+            before = decode_message_cursor(page["before"])
+
+        # Verify that every message was returned exactly once, newest first
+        self.assertEqual(sorted(created_ids, reverse=True), seen_ids)
+
+
+class RoomMembersTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_recent_backend().clear()
+        self.test_room = Room.objects.create(name="Enterprise")
+        self.test_user = User.objects.create(nick="Picard", avatar="http://example.com")
+
+    def test_membership_decided_by_database(self):
+
+        # Verify that adding a member bumps the version, and that the unique constraint refuses adding them again
+        self.assertEqual(1, self.test_room.add_member(self.test_user.id))
+        self.assertIsNone(self.test_room.add_member(self.test_user.id))
+
+        # Verify that removing them works once
+        self.assertIsNotNone(self.test_room.remove_member(self.test_user.id))
+        self.assertIsNone(self.test_room.remove_member(self.test_user.id))
+
+
+class RenderedMessagesTestCase(TestCase):
+
+    def setUp(self):
+        self.test_room = Room.objects.create(name="Enterprise")
+        self.test_user = User.objects.create(nick="Picard", avatar="http://example.com")
+
+    def test_rendered_matches_data(self):
+        for index in range(3):
+            Message.objects.create(room=self.test_room, user=self.test_user, msg="message %d" % index)
+
+        data_page = self.test_room.messages()
+        rendered_page = self.test_room.messages(rendered=True)
+
+        # Verify that the stored representations encode to exactly what the dictionaries do
+        self.assertEqual(codec.dumps(data_page), codec.dumps(rendered_page))
+
+    def test_unrendered_message(self):
+        msg = Message.objects.create(room=self.test_room, user=self.test_user, msg="from before rendering")
+        Message.objects.filter(id=msg.id).update(rendered='')
+
+        # Verify that a message without a stored representation is rendered when read, and stored for next time
+        page = self.test_room.messages(rendered=True)
+        self.assertEqual(msg.id, codec.loads(codec.dumps(page))["messages"][0]["id"])
+        self.assertEqual(msg.rendered, Message.objects.get(id=msg.id).rendered)
+
+
+class RoomCountersTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.test_room = Room.objects.create(name="Enterprise")
+        self.test_user = User.objects.create(nick="Picard", avatar="http://example.com")
+
+    def _counters(self):
+        return Room.objects.filter(id=self.test_room.id).values('message_count', 'member_count', 'last_message_id')[0]
+
+    def test_counters_maintained(self):
+        first = Message.objects.create(room=self.test_room, user=self.test_user, msg="first")
+        batch = self.test_room.add_messages([{"user": self.test_user.id, "msg": "batch %d" % index}
+                                            for index in range(3)])
+
+        self.test_room.add_member(self.test_user.id)
+        self.assertEqual({"message_count": 4, "member_count": 1, "last_message_id": batch[-1]["id"]},
+                         self._counters())
+
+        # Verify that removing a member who has already gone leaves the count alone
+        self.test_room.remove_member(self.test_user.id)
+        self.test_room.remove_member(self.test_user.id)
+        self.assertEqual(0, self._counters()["member_count"])
+
+        # Verify that a message older than the newest doesn't become the newest
+        Room.record_messages(self.test_room.id, 1, first.id, first.timestamp)
+        self.assertEqual({"message_count": 5, "member_count": 0, "last_message_id": batch[-1]["id"]},
+                         self._counters())
+
+    def test_reconcile_counters(self):
+        Message.objects.create(room=self.test_room, user=self.test_user, msg="first")
+        self.test_room.add_member(self.test_user.id)
+        self.assertEqual({}, Room.reconcile_counters())
+
+        # Rows written without going through the model make the counters drift
+        newest = Message.objects.bulk_create([Message(room=self.test_room, user=self.test_user, msg="bulk")])
+        self.test_room.members.through.objects.all().delete()
+
+        drifted = Room.reconcile_counters(dry_run=True)
+        self.assertEqual({"message_count": 2, "member_count": 0}, {name: drifted[self.test_room.id][name]
+                                                                   for name in ("message_count", "member_count")})
+        self.assertEqual(1, self._counters()["member_count"])
+
+        Room.reconcile_counters([self.test_room.id])
+        newest_id = Message.objects.filter(room=self.test_room).order_by('-id').values_list('id', flat=True)[0]
+        self.assertEqual({"message_count": 2, "member_count": 0, "last_message_id": newest_id}, self._counters())
+        self.assertEqual(newest[0].timestamp, Room.objects.get(id=self.test_room.id).last_activity)
+        self.assertEqual({}, Room.reconcile_counters())
+
+    def test_newest_by_timestamp(self):
+        newest = Message.objects.create(room=self.test_room, user=self.test_user, msg="newest")
+        Message.objects.create(room=self.test_room, user=self.test_user, msg="back-dated",
+                               timestamp=newest.timestamp - timedelta(minutes=5))
+
+        # Verify that a back-dated message, though it has the higher ID, doesn't become the newest or move the room's
+        # activity back, whether counted as it was written or recounted
+        self.assertEqual(newest.id, self._counters()["last_message_id"])
+        self.assertEqual(newest.timestamp, Room.objects.get(id=self.test_room.id).last_activity)
+        self.assertEqual({}, Room.reconcile_counters())
+
+        # Verify that the activity summary agrees with the history
+        items = [{"id": self.test_room.id}]
+        Room.add_activity(items)
+        self.assertEqual(self.test_room.messages(msg_count=1)["messages"][0]["id"], items[0]["last_message"]["id"])
+
+    def test_user_deleted(self):
+        other_user = User.objects.create(nick="Riker", avatar="http://example.com")
+        Message.objects.create(room=self.test_room, user=other_user, msg="first")
+        Message.objects.create(room=self.test_room, user=self.test_user, msg="last")
+        self.test_room.add_member(self.test_user.id)
+        self.test_room.add_member(other_user.id)
+
+        version = Room.member_version_of(self.test_room.id)
+        room_cache.set_recent_messages(self.test_room.id, self.test_room.messages(),
+                                       room_cache.recent_messages_version(self.test_room.id))
+        self.test_user.delete()
+
+        # Verify that the room no longer counts the user's message or membership, and its history is read again
+        self.assertEqual({"message_count": 1, "member_count": 1,
+                          "last_message_id": Message.objects.get(msg="first").id}, self._counters())
+        self.assertEqual(version + 1, Room.member_version_of(self.test_room.id))
+        self.assertIsNone(room_cache.get_recent_messages(self.test_room.id))
@@ -0,0 +1,56 @@
+from threading import Event
+from time import sleep
+from django.test import SimpleTestCase
+from .publisher import Publisher
+
+
+class PublisherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.published = []
+
+    def _record(self, stream, event_text):
+        self.published.append((stream, event_text))
+
+    def test_coalesces_per_stream(self):
+
+        # Use a long window so that every event lands in the same batch
+        publisher = Publisher(publish_func=self._record, window=0.2)
+
+        publisher.publish("messages-1", "a")
+        publisher.publish("members-1", "b")
+        publisher.publish("messages-1", "c")
+        self.assertTrue(publisher.flush(timeout=5))
+
+        # Verify one publish call per stream, with the events in order
+        self.assertEqual([("messages-1", "ac"), ("members-1", "b")], self.published)
+
+        stats = publisher.stats()
+        self.assertEqual(3, stats["published"])
+        self.assertEqual(2, stats["publish_calls"])
+
+    def test_drops_when_full(self):
+
+        # Block the worker inside its first publish call so that the queue fills up behind it
+        release = Event()
+
+        def blocked_publish(stream, event_text):
+            release.wait(5)
+            self._record(stream, event_text)
+
+        publisher = Publisher(publish_func=blocked_publish, window=0, queue_size=1, put_timeout=0)
+
+        publisher.publish("messages-1", "a")
+
+        # Wait for the worker to pick up the first event, then fill the queue
+        while publisher.stats()["queue_depth"]:
+            sleep(0.001)
+        self.assertTrue(publisher.publish("messages-1", "b"))
+        self.assertFalse(publisher.publish("messages-1", "c"))
+
+        release.set()
+        self.assertTrue(publisher.flush(timeout=5))
+
+        # Verify that the dropped event was counted and never published
+        self.assertEqual(1, publisher.stats()["dropped"])
+        self.assertEqual(["a", "b"], [event_text for stream, event_text in self.published])
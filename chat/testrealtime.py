@@ -0,0 +1,115 @@
+from json import dumps
+from unittest.mock import patch
+from django.test import SimpleTestCase, TestCase, Client
+from django.core.cache import cache
+from .cache import get_recent_backend
+from .models import Room, User
+from .publisher import SyncPublisher
+from .realtime import HubBackend
+
+
+class HubTestCase(SimpleTestCase):
+
+    def test_fanout(self):
+        hub = HubBackend(keepalive=0.01)
+        first = iter(hub.subscribe(None, "messages-1", lambda: [(None, "replayed")]).streaming_content)
+        second = iter(hub.subscribe(None, "messages-1").streaming_content)
+        other = iter(hub.subscribe(None, "messages-2").streaming_content)
+
+        hub.publish("messages-1", "event")
+
+        # Verify that both subscribers of the stream got the event, after any initial text
+        self.assertEqual([b"replayed", b"event"], [next(first), next(first)])
+        self.assertEqual(b"event", next(second))
+
+        # Verify that the other stream only gets keepalives
+        self.assertEqual(b":\n\n", next(other))
+        self.assertEqual(2, hub.stats()["delivered"])
+        self.assertEqual(3, hub.stats()["subscribers"])
+
+    def test_replay_after_subscribing(self):
+        hub = HubBackend(keepalive=0.01)
+
+        # An event published while the replay is being read, e.g. by another request thread
+        def replay():
+            hub.publish("messages-1", "id: 2\nevent: create\ndata: {}\n\nid: 3\nevent: create\ndata: {}\n\n")
+            return [("1", "id: 1\nevent: create\ndata: {}\n\n"), ("2", "id: 2\nevent: create\ndata: {}\n\n")]
+
+        content = iter(hub.subscribe(None, "messages-1", replay).streaming_content)
+
+        # Verify that the subscriber gets the replay, then only the part of the concurrent event it didn't contain
+        self.assertEqual(b"id: 1\nevent: create\ndata: {}\n\nid: 2\nevent: create\ndata: {}\n\n", next(content))
+        self.assertEqual(b"id: 3\nevent: create\ndata: {}\n\n", next(content))
+
+    def test_failed_replay_unsubscribes(self):
+        hub = HubBackend()
+
+        def replay():
+            raise ValueError("Invalid cursor")
+
+        # Verify that a replay that fails leaves no subscriber behind
+        with self.assertRaises(ValueError):
+            hub.subscribe(None, "messages-1", replay)
+        self.assertEqual(0, hub.stats()["subscribers"])
+
+    def test_slow_consumer_dropped(self):
+        hub = HubBackend(max_buffer=1)
+        response = hub.subscribe(None, "messages-1")
+
+        hub.publish("messages-1", "a")
+        hub.publish("messages-1", "b")
+
+        # Verify that the subscriber was dropped once its buffer overflowed, and its stream ends
+        self.assertEqual(1, hub.stats()["dropped"])
+        self.assertEqual(0, hub.stats()["subscribers"])
+        self.assertEqual([], list(response.streaming_content))
+
+    def test_close_unsubscribes(self):
+        hub = HubBackend()
+        response = hub.subscribe(None, "messages-1")
+
+        # Verify that closing the response, as the server does when the client goes away, removes the subscriber
+        response.close()
+        self.assertEqual(0, hub.stats()["subscribers"])
+        self.assertEqual(0, hub.stats()["streams"])
+
+    def test_subscriber_limit(self):
+        hub = HubBackend(max_subscribers=1)
+        hub.subscribe(None, "messages-1")
+
+        # Verify that subscribers over the limit are turned away
+        self.assertEqual(503, hub.subscribe(None, "messages-2").status_code)
+        self.assertEqual(1, hub.stats()["rejected"])
+
+
+class HubViewTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        get_recent_backend().clear()
+
+        # Route subscriptions and publishing through a hub
+        self.hub = HubBackend(keepalive=0.01)
+        for target, value in (('chat.decorators.get_realtime_backend', lambda: self.hub),
+                              ('chat.decorators.get_publisher', lambda: SyncPublisher(self.hub.publish))):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.room = Room.objects.create(name="hub")
+        self.user = User.objects.create(nick="hub", avatar="http://example.com/hub.png")
+        self.url = "/api/rooms/%d/messages/" % self.room.id
+
+    def test_message_delivered(self):
+        client = Client()
+        response = client.get(self.url, HTTP_ACCEPT='text/event-stream')
+        self.assertTrue(response.streaming)
+        content = iter(response.streaming_content)
+
+        client.post(self.url, dumps({"user": self.user.id, "msg": "hello"}), content_type='application/json')
+
+        # Verify the subscriber received the new message as a create event
+        event = next(content).decode('utf-8')
+        self.assertIn("event: create", event)
+        self.assertIn('"msg":"hello"', event)
+        response.close()
@@ -0,0 +1,76 @@
+from django.test import TestCase
+from django.db import connections
+from . import instrumentation, slowqueries
+from .models import Room, SlowQuery
+
+
+class FingerprintTestCase(TestCase):
+
+    def test_literals_ignored(self):
+        first = slowqueries.fingerprint("SELECT * FROM chat_room WHERE id = 1 AND name = 'a'  LIMIT 21")
+        second = slowqueries.fingerprint("SELECT * FROM chat_room WHERE id = 22 AND name = 'it''s' LIMIT 21")
+
+        # Verify that queries differing only in their literals share a fingerprint
+        self.assertEqual(first, second)
+        self.assertEqual("SELECT * FROM chat_room WHERE id = ? AND name = ? LIMIT ?", first[1])
+
+    def test_lists_collapsed(self):
+        first = slowqueries.fingerprint('SELECT "id" FROM "chat_user" WHERE "id" IN (%s, %s, %s)')
+        second = slowqueries.fingerprint('SELECT "id" FROM "chat_user" WHERE "id" IN (%s)')
+
+        # Verify that IN lists of any length share a fingerprint, and identifiers containing digits are kept
+        self.assertEqual(first, second)
+        self.assertNotEqual(slowqueries.fingerprint("SELECT t1.id FROM t1")[0],
+                            slowqueries.fingerprint("SELECT t2.id FROM t2")[0])
+
+
+class SlowQueryTestCase(TestCase):
+
+    def setUp(self):
+        # Record every query, for this test only
+        instrumentation.instrument_connection(connections['default'])
+        slowqueries.watch(threshold=0)
+        self.addCleanup(slowqueries.unwatch)
+
+        # Don't leave this test's queries waiting to be recorded by the next one
+        self.addCleanup(slowqueries.flush)
+
+    def test_record(self):
+        room = Room.objects.create(name="slow")
+
+        for attempt in range(3):
+            list(Room.objects.filter(id=room.id))
+
+        slowqueries.flush()
+
+        # Verify that the recorder didn't record its own queries
+        self.assertFalse(SlowQuery.objects.filter(normalized__contains="chat_slowquery").exists())
+
+        # Verify the repeated lookup was recorded once, with a count and the plan of its slowest run
+        entry = SlowQuery.objects.get(normalized__startswith='SELECT "chat_room"."id"')
+        self.assertEqual(3, entry.count)
+        self.assertGreaterEqual(entry.total_time, entry.max_time)
+        self.assertTrue(entry.plan)
+
+        # Verify that writes are recorded without being explained
+        insert = SlowQuery.objects.get(normalized__startswith='INSERT INTO "chat_room"')
+        self.assertEqual('', insert.plan)
+
+    def test_executemany(self):
+        with connections['default'].cursor() as cursor:
+            cursor.executemany("INSERT INTO chat_room (name, member_version, last_activity, message_count, "
+                               "member_count) VALUES (%s, 0, '2000-01-01', 0, 0)", [("one",), ("two",)])
+
+        slowqueries.flush()
+
+        # Verify that queries run with executemany() are timed and recorded too
+        self.assertEqual(1, SlowQuery.objects.get(normalized__startswith='INSERT INTO chat_room').count)
+
+    def test_bounded(self):
+        with self.settings(CHAT_SLOW_QUERY_MAX_ENTRIES=2):
+            for table in ("chat_room", "chat_user", "chat_message"):
+                connections['default'].cursor().execute("SELECT COUNT(*) FROM %s" % table)
+                slowqueries.flush()
+
+        # Verify only the top entries were kept
+        self.assertEqual(2, SlowQuery.objects.count())
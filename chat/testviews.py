@@ -1,6 +1,29 @@
 from django.test import TestCase, Client
+from django.db import connections
+from django.core.cache import cache
+from .cache import get_recent_backend
 from json import dumps, loads
+from shutil import rmtree
+from tempfile import mkdtemp
+import os
+from unittest.mock import patch
+from .middleware import QueryLog
 from .models import Room, User, Message
+from .pagination import decode_message_cursor
+from .publisher import SyncPublisher
+from .views import MessageView, UserView
+from . import metrics, slowqueries
+
+
+def parse_events(body):
+    """ Split an event stream into its events, each a dictionary of its fields (id, event and data). """
+    events = []
+
+    for frame in body.split("\n\n"):
+        if frame:
+            events.append(dict(line.split(": ", 1) for line in frame.split("\n")))
+
+    return events
 
 
 class ViewTestBase(TestCase):
@@ -15,6 +38,10 @@ class ViewTestBase(TestCase):
         """
         self._client = Client()
 
+        # Cached state from earlier tests may refer to rows that have since been rolled back
+        cache.clear()
+        get_recent_backend().clear()
+
         if not hasattr(self, '_endpoint'):
             raise NotImplementedError("Please specify an _endpoint member for your view test class")
 
@@ -86,6 +113,107 @@ class UserViewTests(ViewTestBase):
         # Verify that the list contained in the "users" key is equal to the number of users we created (2).
         self.assertEqual(2, len(result_data["users"]))
 
+    def test_get_paged(self):
+        """ Test reading the user collection one page at a time. """
+        for nick in ["riker", "worf", "troi"]:
+            self._create(nick=nick, avatar="http://example.com")
+
+        # Read the first page of two users
+        first_page = loads(self._read(limit=2).content.decode('utf-8'))
+        self.assertEqual(["riker", "worf"], [user["nick"] for user in first_page["users"]])
+        self.assertIsNotNone(first_page["cursor"])
+
+        # Read the remaining page using the cursor
+        second_page = loads(self._read(limit=2, cursor=first_page["cursor"]).content.decode('utf-8'))
+        self.assertEqual(["troi"], [user["nick"] for user in second_page["users"]])
+        self.assertIsNone(second_page["cursor"])
+
+    def test_get_paged_bad_limit(self):
+        """ Test reading the user collection with an invalid page size. """
+        response = self._read(limit=0)
+
+        # Verify error status returned
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_streamed(self):
+        """ Test streaming the whole user collection. """
+        for nick in ["riker", "worf", "troi"]:
+            self._create(nick=nick, avatar="http://example.com")
+
+        # Use a tiny chunk size so that the collection spans several chunks
+        with patch.object(UserView, '_stream_chunk_size', 2):
+            response = self._read(stream=1)
+            self.assertEqual(response.status_code, 200)
+
+            # Reassemble and deserialize the streamed body
+            result_data = loads(b"".join(response.streaming_content).decode('utf-8'))
+
+        # Verify that every user was included
+        self.assertEqual(["riker", "worf", "troi"], [user["nick"] for user in result_data["users"]])
+
+    def test_get_stream_flag(self):
+        """ Test that the stream parameter is read as a boolean. """
+        response = self._read(stream="false")
+        self.assertFalse(response.streaming)
+        self.assertIn("cursor", loads(response.content.decode('utf-8')))
+
+        self.assertTrue(self._read(stream="true").streaming)
+        self.assertEqual(self._read(stream="maybe").status_code, 400)
+
+    def test_get_by_ids(self):
+        """ Test looking up several users at once, in the order requested. """
+        users = [loads(self._create(nick=nick, avatar="http://example.com").content.decode('utf-8'))
+                 for nick in ["riker", "worf", "troi"]]
+
+        # Ask for two users in reverse order, a duplicate and a user that doesn't exist, with a single query for the
+        # users (and one for the ETag validator)
+        ids = [users[2]["id"], users[0]["id"], users[2]["id"], 999999]
+        with self.assertNumQueries(2):
+            response = self._read(ids=",".join(map(str, ids)))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(["troi", "riker"], [user["nick"] for user in loads(response.content.decode('utf-8'))["users"]])
+
+    def test_get_by_ids_bad_list(self):
+        """ Test that malformed and oversized ID lists are rejected. """
+        self.assertEqual(self._read(ids="1,two").status_code, 400)
+
+        with patch.object(UserView, '_max_ids', 2):
+            self.assertEqual(self._read(ids="1,2,3").status_code, 400)
+
+    def test_get_sparse_fields(self):
+        """ Test that a sparse fieldset narrows each user to the requested fields, plus the ID. """
+        new_user = loads(self._create(nick="riker", avatar="http://example.com").content.decode('utf-8'))
+
+        result_data = loads(self._read(fields="nick").content.decode('utf-8'))
+        self.assertEqual([{"id": new_user["id"], "nick": "riker"}], result_data["users"])
+
+        result_data = loads(self._read(new_user["id"], fields="nick").content.decode('utf-8'))
+        self.assertEqual({"id": new_user["id"], "nick": "riker"}, result_data)
+
+        result_data = loads(self._read(ids=str(new_user["id"]), fields="avatar").content.decode('utf-8'))
+        self.assertEqual([{"id": new_user["id"], "avatar": "http://example.com"}], result_data["users"])
+
+    def test_get_sparse_fields_unknown(self):
+        """ Test that asking for a field the representation doesn't have is rejected. """
+        self.assertEqual(self._read(fields="nick,password").status_code, 400)
+
+    def test_get_not_modified(self):
+        """ Test that a client holding the current collection gets a 304 response, until a user changes. """
+        new_user = loads(self._create(nick="riker", avatar="http://example.com").content.decode('utf-8'))
+        etag = self._read()['ETag']
+
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Verify that the validator depends on the query parameters too
+        response = self._client.get(self._endpoint, {"limit": 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        self._delete(new_user["id"])
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
     def test_get_one(self):
         """ Test creating a user and reading that user specifically. """
         new_user_response = self._create(nick="riker", avatar="http://example.com")
@@ -234,6 +362,27 @@ class RoomViewTests(ViewTestBase):
         # Verify that the name field has been updated
         self.assertEqual(result_data["name"], new_name)
 
+    def test_post_counters(self):
+        """ Test that a room can't be created with its counters set. """
+        response = self._create(name="x", message_count=999, member_count=7, member_version=50)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Room.objects.filter(name="x").exists())
+
+    def test_put_counters(self):
+        """ Test that a room's counters can't be written, and a rename leaves them alone. """
+        room = Room.objects.create(name="vulcan")
+
+        response = self._update(room.id, message_count=1000)
+        self.assertEqual(response.status_code, 400)
+
+        with QueryLog(connections['default']) as queries:
+            self._update(room.id, name="romulus")
+
+        updates = [query["sql"] for query in queries.queries if query["sql"].startswith('UPDATE "chat_room"')]
+        self.assertEqual(1, len(updates))
+        self.assertNotIn("message_count", updates[0])
+        self.assertNotIn("member_version", updates[0])
+
     def test_delete(self):
         """ Test deleting a room. """
         new_room_response = self._create(name="cardassia")
@@ -253,6 +402,79 @@ class RoomViewTests(ViewTestBase):
         # Verify a not found status
         self.assertTrue(response.status_code, 404)
 
+    def _create_rooms_with_activity(self):
+        """ Create three rooms, the last created first to see any messages, and the first without any. """
+        user = User.objects.create(nick="Picard", avatar="http://example.com")
+        rooms = [Room.objects.create(name=name) for name in ["Bridge", "Ten Forward", "Holodeck"]]
+
+        rooms[0].add_member(user.id)
+        rooms[2].add_member(user.id)
+
+        for room, text in [(rooms[2], "first"), (rooms[1], "second"), (rooms[1], "third")]:
+            self._client.post("/api/rooms/%d/messages/" % room.id, data=dumps({"user": user.id, "msg": text}),
+                              content_type='application/json')
+
+        return rooms
+
+    def test_get_activity(self):
+        """ Test that rooms can be listed with a summary of their activity, in a fixed number of queries. """
+        rooms = self._create_rooms_with_activity()
+
+        # One query each for the ETag validators and the page, and two for the summaries
+        with self.assertNumQueries(5):
+            response = self._read(include="activity")
+
+        self.assertEqual(response.status_code, 200)
+        summaries = {room["id"]: room for room in loads(response.content.decode('utf-8'))["rooms"]}
+
+        self.assertEqual(0, summaries[rooms[0].id]["message_count"])
+        self.assertEqual(1, summaries[rooms[0].id]["member_count"])
+        self.assertIsNone(summaries[rooms[0].id]["last_message"])
+
+        self.assertEqual(2, summaries[rooms[1].id]["message_count"])
+        self.assertEqual(0, summaries[rooms[1].id]["member_count"])
+        self.assertEqual("third", summaries[rooms[1].id]["last_message"]["msg"])
+
+        # A single room can be summarized too
+        result_data = loads(self._read(rooms[2].id, include="activity").content.decode('utf-8'))
+        self.assertEqual("first", result_data["last_message"]["msg"])
+
+    def test_get_activity_not_modified(self):
+        """ Test that new messages change the validator of the summarized list, but not of the plain list. """
+        rooms = self._create_rooms_with_activity()
+        plain_etag = self._read()['ETag']
+        etag = self._read(include="activity")['ETag']
+
+        Message.objects.create(room=rooms[0], user=User.objects.get(nick="Picard"), msg="fourth")
+
+        self.assertNotEqual(etag, self._read(include="activity")['ETag'])
+        self.assertEqual(plain_etag, self._read()['ETag'])
+
+        # Verify that a back-dated message, which leaves the newest activity alone, changes it too
+        etag = self._read(include="activity")['ETag']
+        self._client.post("/api/rooms/%d/messages/" % rooms[2].id, content_type='application/json',
+                          data=dumps({"user": User.objects.get(nick="Picard").id, "msg": "past",
+                                      "timestamp": "2000-01-01T00:00:00"}))
+        self.assertNotEqual(etag, self._read(include="activity")['ETag'])
+
+    def test_get_sorted_by_activity(self):
+        """ Test that rooms can be listed by most recent activity, a page at a time. """
+        rooms = self._create_rooms_with_activity()
+
+        result_data = loads(self._read(sort="activity", limit=2).content.decode('utf-8'))
+        self.assertEqual([rooms[1].id, rooms[2].id], [room["id"] for room in result_data["rooms"]])
+        self.assertNotIn("last_activity", result_data["rooms"][0])
+
+        result_data = loads(self._read(sort="activity", limit=2, cursor=result_data["cursor"]).content.decode('utf-8'))
+        self.assertEqual([rooms[0].id], [room["id"] for room in result_data["rooms"]])
+        self.assertIsNone(result_data["cursor"])
+
+    def test_get_unsupported_include_and_sort(self):
+        """ Test that unknown summaries and orders are rejected, as is summarizing a streamed list. """
+        self.assertEqual(self._read(include="weather").status_code, 400)
+        self.assertEqual(self._read(sort="name").status_code, 400)
+        self.assertEqual(self._read(include="activity", stream=1).status_code, 400)
+
 
 class MessageViewTests(ViewTestBase):
     """ Test our message view. """
@@ -293,6 +515,85 @@ class MessageViewTests(ViewTestBase):
         input_data_set = set(input_data.items())
         self.assertTrue(input_data_set.issubset(result_data_set))
 
+    def _create_batch(self, batch):
+        return self._client.post(self._endpoint, data=dumps(batch), content_type='application/json')
+
+    def test_post_without_msg(self):
+        """ Test that a message without text is refused, and not published. """
+        with patch('chat.decorators.get_publisher') as get_publisher:
+            for data in ({"user": self.test_user.id}, {"user": self.test_user.id, "msg": ""},
+                         {"user": self.test_user.id, "msg": 7}):
+                self.assertEqual(self._create(**data).status_code, 400)
+
+        self.assertFalse(get_publisher.called)
+        self.assertFalse(Message.objects.exists())
+
+    def test_post_back_dated(self):
+        """ Test that a back-dated message doesn't move the room's activity backwards. """
+        newest = loads(self._create(user=self.test_user.id, msg="newest").content.decode('utf-8'))
+        self._create(user=self.test_user.id, msg="back-dated", timestamp="2000-01-01T00:00:00")
+
+        room = Room.objects.get(id=self.test_room.id)
+        self.assertEqual(newest["id"], room.last_message_id)
+        self.assertEqual(2, room.message_count)
+
+        # Verify that timestamps must be timestamps
+        response = self._create(user=self.test_user.id, msg="when?", timestamp="yesterday")
+        self.assertEqual(response.status_code, 400)
+
+    def test_post_batch(self):
+        """ Test creating several messages with one request. """
+        batch = [{"user": self.test_user.id, "msg": "message %d" % index} for index in range(3)]
+        response = self._create_batch(batch)
+
+        # Verify created status returned
+        self.assertEqual(response.status_code, 201)
+
+        # Verify that every message was created, in order, with its own ID
+        result_data = loads(response.content.decode('utf-8'))
+        self.assertEqual([item["msg"] for item in batch], [msg["msg"] for msg in result_data["messages"]])
+        self.assertEqual(3, len(set(msg["id"] for msg in result_data["messages"])))
+
+        # Verify that reading the messages back returns the same data
+        history = loads(self._read().content.decode('utf-8'))
+        self.assertEqual(list(reversed(result_data["messages"])), history["messages"])
+
+    def test_post_batch_unknown_user(self):
+        """ Test creating a batch of messages that refers to a user who doesn't exist. """
+        response = self._create_batch([{"user": self.test_user.id, "msg": "hello"},
+                                       {"user": self.test_user.id + 1, "msg": "hello"}])
+
+        # Verify error status returned, and that nothing was created
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(0, Message.objects.count())
+
+    def test_post_batch_bad_msg(self):
+        """ Test creating a batch of messages where one has no usable text. """
+        for bad_msg in (None, "", 42, "x" * 4001):
+            response = self._create_batch([{"user": self.test_user.id, "msg": "hello"},
+                                           {"user": self.test_user.id, "msg": bad_msg}])
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(0, Message.objects.count())
+
+    def test_post_batch_published(self):
+        """ Test that a batch is published as one well-formed event per message, tagged with its cursor. """
+        published = []
+
+        with patch('chat.decorators.get_publisher', lambda: SyncPublisher(lambda *args: published.append(args))):
+            result_data = loads(self._create_batch([{"user": self.test_user.id, "msg": "message %d" % index}
+                                                    for index in range(2)]).content.decode('utf-8'))
+
+        self.assertEqual(1, len(published))
+        self.assertEqual("messages-%d" % self.test_room.id, published[0][0])
+
+        events = parse_events(published[0][1])
+        self.assertEqual(["create", "create"], [event["event"] for event in events])
+        self.assertEqual(result_data["messages"], [loads(event["data"]) for event in events])
+        self.assertEqual([msg["id"] for msg in result_data["messages"]],
+                         [decode_message_cursor(event["id"])[1] for event in events])
+        self.assertEqual(loads(self._read().content.decode('utf-8'))["after"], events[-1]["id"])
+
     def test_get_all(self):
         """ Test creating multiple messages and getting them all back at once. """
         self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
@@ -360,6 +661,185 @@ class MessageViewTests(ViewTestBase):
         # Verify that we got back the older message of the two.
         self.assertDictEqual(new_message1, result_data["messages"][0])
 
+    def test_get_previous_by_cursor(self):
+        """ Test paging backwards with the opaque cursor returned alongside each page. """
+        for index in range(51):
+            self._create(room=self.test_room.id, user=self.test_user.id, msg="message %d" % index)
+
+        # Read the newest page, which should be full and point at an older page
+        first_page = loads(self._read().content.decode('utf-8'))
+        self.assertEqual(50, len(first_page["messages"]))
+        self.assertIsNotNone(first_page["before"])
+
+        # Read the older page using the cursor
+        response = self._read(before=first_page["before"])
+        self.assertEqual(response.status_code, 200)
+        second_page = loads(response.content.decode('utf-8'))
+
+        # Verify that only the oldest message remains and that there is nothing beyond it
+        self.assertEqual(1, len(second_page["messages"]))
+        self.assertEqual("message 0", second_page["messages"][0]["msg"])
+        self.assertIsNone(second_page["before"])
+
+    def test_get_next(self):
+        """ Test catching up on messages posted after a previously read page. """
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
+        first_page = loads(self._read().content.decode('utf-8'))
+
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="second message ever")
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="third message ever")
+
+        # Read everything newer than the first page
+        response = self._read(after=first_page["after"])
+        self.assertEqual(response.status_code, 200)
+        result_data = loads(response.content.decode('utf-8'))
+
+        # Verify that we got back only the new messages, oldest first
+        self.assertEqual(["second message ever", "third message ever"],
+                         [msg["msg"] for msg in result_data["messages"]])
+
+        # Verify that catching up again from the returned cursor finds nothing new
+        result_data = loads(self._read(after=result_data["after"]).content.decode('utf-8'))
+        self.assertEqual(0, len(result_data["messages"]))
+
+    def test_stream_resume(self):
+        """ Test that a reconnecting stream subscriber is sent only the messages it missed. """
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
+        first_page = loads(self._read().content.decode('utf-8'))
+
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="second message ever")
+
+        # Reconnect with the last event ID the browser saw
+        response = self._client.get(self._endpoint, HTTP_ACCEPT='text/event-stream',
+                                    HTTP_LAST_EVENT_ID=first_page["after"])
+        self.assertEqual(response.status_code, 200)
+
+        # Verify that only the missed message was replayed
+        events = parse_events(response.content.decode('utf-8'))
+        self.assertEqual(1, len(events))
+        self.assertEqual("create", events[0]["event"])
+        self.assertEqual("second message ever", loads(events[0]["data"])["msg"])
+
+        # Verify the replayed event carries the message's cursor as its ID, for the next reconnect
+        second_page = loads(self._read().content.decode('utf-8'))
+        self.assertEqual(second_page["after"], events[0]["id"])
+
+    def test_include_user(self):
+        """ Test that message authors can be sideloaded, each once, with a single extra query. """
+        second_user = User.objects.create(nick="Riker", avatar="http://example.com/riker.png")
+
+        for user in (self.test_user, second_user, self.test_user):
+            self._create(room=self.test_room.id, user=user.id, msg="message from %s" % user.nick)
+
+        # Fill the cache, then verify that sideloading costs one query for the authors, and one for the users'
+        # collection version that goes into the ETag, besides the room's message counters
+        self._read()
+        with self.assertNumQueries(3):
+            response = self._read(include="user")
+
+        self.assertEqual(response.status_code, 200)
+        result_data = loads(response.content.decode('utf-8'))
+
+        self.assertEqual(3, len(result_data["messages"]))
+        self.assertEqual({str(self.test_user.id), str(second_user.id)}, set(result_data["users"]))
+        self.assertEqual("Riker", result_data["users"][str(second_user.id)]["nick"])
+
+        # Verify that a change to an author changes the ETag of the sideloading page, but not of the plain page
+        plain_etag = self._read()['ETag']
+        etag = response['ETag']
+        second_user.update_data(avatar="http://example.com/riker-2.png")
+        second_user.save()
+
+        self.assertNotEqual(etag, self._read(include="user")['ETag'])
+        self.assertEqual(plain_etag, self._read()['ETag'])
+
+    def test_get_sparse_fields(self):
+        """ Test that a sparse fieldset narrows each message, always keeping the ID and timestamp. """
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
+
+        result_data = loads(self._read(fields="msg").content.decode('utf-8'))
+        self.assertEqual(1, len(result_data["messages"]))
+        self.assertEqual({"id", "timestamp", "msg"}, set(result_data["messages"][0]))
+
+        # Sideloading still works, even though the author wasn't asked for
+        result_data = loads(self._read(fields="msg", include="user").content.decode('utf-8'))
+        self.assertEqual([str(self.test_user.id)], list(result_data["users"]))
+
+        self.assertEqual(self._read(fields="room,secret").status_code, 400)
+
+    def test_include_unsupported(self):
+        """ Test that sideloading an unknown relation is rejected. """
+        response = self._read(include="room")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_cached(self):
+        """ Test that the newest page is served from the cache, and that new messages are merged into it. """
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
+
+        # The first read fills the cache, the second should only read the room's message counters for the ETag
+        first_page = loads(self._read().content.decode('utf-8'))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(first_page, loads(self._read().content.decode('utf-8')))
+
+        # Post another message, and verify that the next read includes it without reading the page again
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="second message ever")
+
+        with self.assertNumQueries(1):
+            result_data = loads(self._read().content.decode('utf-8'))
+
+        self.assertEqual(["second message ever", "first message ever"],
+                         [msg["msg"] for msg in result_data["messages"]])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(result_data, loads(self._read().content.decode('utf-8')))
+
+    def test_get_not_modified(self):
+        """ Test that a client holding the current history gets a 304 response. """
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
+        response = self._read()
+
+        # Verify that re-reading with the returned ETag is answered without a body
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Post another message, and verify that the same ETag now gets the full page
+        self._create(room=self.test_room.id, user=self.test_user.id, msg="second message ever")
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_modified_by_back_dated_message(self):
+        """ Test that a message landing inside the newest page, rather than after it, changes the ETag. """
+        self._create(user=self.test_user.id, msg="first message ever")
+        etag = self._read()['ETag']
+
+        self._create(user=self.test_user.id, msg="from the past", timestamp="2000-01-01T00:00:00")
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(2, len(loads(response.content.decode('utf-8'))["messages"]))
+
+    def test_get_cached_merges_a_page(self):
+        """ Test that merging new messages into the cached page keeps it the size of a page, with a cursor to the rest.
+        """
+        self.test_room.add_messages([{"user": self.test_user.id, "msg": str(i)} for i in range(MessageView._page_size)])
+        self._read()
+
+        self._create(user=self.test_user.id, msg="newest")
+        result_data = loads(self._read().content.decode('utf-8'))
+
+        # Verify that the merged page is the one the database would return, and that its cursor pages back from it
+        get_recent_backend().clear()
+        self.assertEqual(loads(self._read().content.decode('utf-8')), result_data)
+        self.assertEqual(["0"], [msg["msg"] for msg in loads(self._read(before=result_data["before"]).content
+                                                             .decode('utf-8'))["messages"]])
+
+    def test_get_previous_bad_cursor(self):
+        """ Test paging backwards with a cursor that was not issued by the server. """
+        response = self._read(before="not-a-cursor")
+
+        # Verify error status returned
+        self.assertEqual(response.status_code, 400)
+
     def test_put(self):
         """ Test updating a message. """
         new_message_response = self._create(room=self.test_room.id, user=self.test_user.id, msg="first message ever")
@@ -428,9 +908,10 @@ class MemberViewTests(ViewTestBase):
         # Deserialize response data
         result_data = loads(response.content.decode('utf-8'))
 
-        # Verify that the member we created is in the resulting member list
-        self.assertIn("members", result_data)
-        self.assertEqual(self.test_user1.id, result_data["members"][0]["id"])
+        # Verify that we got back a join delta for the member we created
+        self.assertEqual("join", result_data["type"])
+        self.assertEqual(self.test_user1.id, result_data["user"]["id"])
+        self.assertEqual(1, result_data["version"])
 
     def test_get_all(self):
         """ Test creating multiple members and getting them all back at once. """
@@ -452,6 +933,77 @@ class MemberViewTests(ViewTestBase):
         # Verify that the list contained in the "members" key is equal to the number of members we created (2).
         self.assertEqual(2, len(result_data["members"]))
 
+    def test_get_sparse_fields(self):
+        """ Test that a sparse fieldset narrows each member to the requested fields, plus the ID. """
+        self._create(user=self.test_user1.id)
+
+        result_data = loads(self._read(fields="nick").content.decode('utf-8'))
+        self.assertEqual([{"id": self.test_user1.id, "nick": "Picard"}], result_data["members"])
+
+        self.assertEqual(self._read(fields="email").status_code, 400)
+
+    def test_get_not_modified_after_member_edit(self):
+        """ Test that a member changing their nick changes the member list's ETag. """
+        self._create(user=self.test_user1.id)
+        etag = self._read()['ETag']
+
+        self.test_user1.update_data(nick="Locutus")
+        self.test_user1.save()
+
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual("Locutus", loads(response.content.decode('utf-8'))["members"][0]["nick"])
+
+    def test_leave_non_member(self):
+        """ Test that removing a user who isn't a member is refused, and leaves the member list's ETag alone. """
+        self._create(user=self.test_user1.id)
+        etag = self._read()['ETag']
+
+        self.assertEqual(self._delete(self.test_user2.id).status_code, 400)
+        self.assertEqual(self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_versions(self):
+        """ Test that membership changes are numbered consecutively, and that snapshots report their version. """
+        versions = [loads(self._create(user=self.test_user1.id).content.decode('utf-8'))["version"],
+                    loads(self._create(user=self.test_user2.id).content.decode('utf-8'))["version"]]
+
+        self.assertEqual([1, 2], versions)
+
+        # Remove a member.  The leave delta is only published, since the response has no content.
+        self._delete(self.test_user1.id)
+
+        # Verify that a snapshot reflects all three changes
+        result_data = loads(self._read().content.decode('utf-8'))
+        self.assertEqual(3, result_data["version"])
+        self.assertEqual([self.test_user2.id], [member["id"] for member in result_data["members"]])
+
+    def test_get_not_modified(self):
+        """ Test that a client holding the current member list gets a 304 response, until the membership changes. """
+        self._create(user=self.test_user1.id)
+        etag = self._read()['ETag']
+
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self._create(user=self.test_user2.id)
+        response = self._client.get(self._endpoint, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_post_duplicate(self):
+        """ Test adding the same member twice. """
+        self._create(user=self.test_user1.id)
+        response = self._create(user=self.test_user1.id)
+
+        # Verify conflict status returned
+        self.assertEqual(response.status_code, 409)
+
+    def test_delete_non_member(self):
+        """ Test removing a user who is not a member of the room. """
+        response = self._delete(self.test_user1.id)
+
+        # Verify error status returned
+        self.assertEqual(response.status_code, 400)
+
     def test_get_one(self):
         """ Test creating one member and attempting to read it back (not supported). """
         self._create(user=self.test_user1.id)
@@ -477,3 +1029,116 @@ class MemberViewTests(ViewTestBase):
 
         # Verify a not found status
         self.assertTrue(response.status_code, 404)
+
+
+class MetricsViewTests(ViewTestBase):
+    _endpoint = "/api/metrics/"
+
+    def setUp(self):
+        super(MetricsViewTests, self).setUp()
+        metrics.reset()
+
+    def test_request_recorded(self):
+        """ Test that a request shows up in the metrics, labelled by view and verb. """
+        self._client.get("/api/users/")
+
+        response = self._read()
+        self.assertEqual(response.status_code, 200)
+
+        body = response.content.decode('utf-8')
+        self.assertIn('chat_request_seconds_count{method="GET",view="UserView"} 1', body)
+        self.assertIn('chat_request_queries_count{method="GET",view="UserView"} 1', body)
+        self.assertIn('chat_response_bytes_count{method="GET",view="UserView"} 1', body)
+
+    def test_queries_counted(self):
+        """ Test that database queries made by a view are counted. """
+        User.objects.create(nick="metrics", avatar="http://example.com/metrics.png")
+        self._client.get("/api/users/")
+
+        body = self._read().content.decode('utf-8')
+
+        # One query for the ETag validator and one for the list itself
+        self.assertIn('chat_request_queries_bucket{method="GET",view="UserView",le="1"} 0', body)
+        self.assertIn('chat_request_queries_bucket{method="GET",view="UserView",le="2"} 1', body)
+
+    def test_stream_measured(self):
+        """ Test that the queries reading a streamed collection are counted, once the stream has been sent. """
+        for nick in ["riker", "worf", "troi"]:
+            User.objects.create(nick=nick, avatar="http://example.com")
+
+        with patch.object(UserView, '_stream_chunk_size', 2):
+            response = self._client.get("/api/users/", {"stream": 1})
+            b"".join(response.streaming_content)
+
+        # One query for the ETag validator and two for the chunks
+        body = self._read().content.decode('utf-8')
+        self.assertIn('chat_request_queries_bucket{method="GET",view="UserView",le="2"} 0', body)
+        self.assertIn('chat_request_queries_bucket{method="GET",view="UserView",le="3"} 1', body)
+        self.assertIn('chat_response_bytes_count{method="GET",view="UserView"} 1', body)
+
+    def test_slow_query_recording_not_counted(self):
+        """ Test that recording a request's slow queries doesn't add to its own query count. """
+        self.addCleanup(slowqueries.unwatch)
+
+        # A fresh client loads the slow query middleware, which records every query
+        with self.settings(CHAT_SLOW_QUERY_THRESHOLD=0):
+            Client().get("/api/users/")
+            slowqueries.flush()
+
+        # One query for the ETag validator and one for the list itself, none for recording them
+        body = self._read().content.decode('utf-8')
+        self.assertIn('chat_request_queries_bucket{method="GET",view="UserView",le="2"} 1', body)
+
+
+class ProfilingTests(ViewTestBase):
+    _endpoint = "/api/rooms/"
+
+    def setUp(self):
+        super(ProfilingTests, self).setUp()
+        self._directory = mkdtemp()
+        self.addCleanup(rmtree, self._directory)
+
+        self.test_room = Room.objects.create(name="profiled")
+
+    def _profiles(self):
+        return sorted(os.listdir(self._directory))
+
+    def test_profile_with_token(self):
+        """ Test that a request carrying the profiling token is profiled, and tagged with its view and room. """
+        with self.settings(CHAT_PROFILE_TOKEN="secret", CHAT_PROFILE_DIR=self._directory):
+            response = Client().get("/api/rooms/%d/messages/" % self.test_room.id, HTTP_X_CHAT_PROFILE="secret")
+
+        self.assertEqual(response.status_code, 200)
+
+        # Verify a call graph and an SQL listing were written, tagged with the view and room
+        profiles = self._profiles()
+        self.assertEqual([".prof", ".sql"], [os.path.splitext(name)[1] for name in profiles])
+        self.assertIn("-MessageView-GET-room%d-" % self.test_room.id, profiles[0])
+
+        with open(os.path.join(self._directory, profiles[1])) as sql_file:
+            self.assertIn("chat_room", sql_file.read())
+
+    def test_room_tagged(self):
+        """ Test that requests for a room itself are tagged with the room. """
+        with self.settings(CHAT_PROFILE_TOKEN="secret", CHAT_PROFILE_DIR=self._directory):
+            Client().get("/api/rooms/%d/" % self.test_room.id, HTTP_X_CHAT_PROFILE="secret")
+
+        self.assertIn("-RoomView-GET-room%d-" % self.test_room.id, self._profiles()[0])
+
+    def test_max_files(self):
+        """ Test that only the newest profiles are kept. """
+        with self.settings(CHAT_PROFILE_TOKEN="secret", CHAT_PROFILE_DIR=self._directory, CHAT_PROFILE_MAX_FILES=2):
+            client = Client()
+            for attempt in range(3):
+                client.get("/api/rooms/", HTTP_X_CHAT_PROFILE="secret")
+
+        # Verify that two profiles remain, each with its SQL listing
+        self.assertEqual([".prof", ".sql"] * 2, [os.path.splitext(name)[1] for name in self._profiles()])
+
+    def test_wrong_token(self):
+        """ Test that requests without the right token aren't profiled. """
+        with self.settings(CHAT_PROFILE_TOKEN="secret", CHAT_PROFILE_DIR=self._directory):
+            Client().get("/api/rooms/", HTTP_X_CHAT_PROFILE="guess")
+            Client().get("/api/rooms/")
+
+        self.assertEqual([], self._profiles())
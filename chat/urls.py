@@ -1,6 +1,6 @@
 from django.conf.urls import patterns, url
 
-from .views import RoomView, UserView, MessageView, MemberView
+from .views import RoomView, UserView, MessageView, MemberView, metrics_view
 
 urlpatterns = patterns('',
     (r'^rooms/$', RoomView.as_view()),
@@ -11,4 +11,5 @@ urlpatterns = patterns('',
     (r'^rooms/(?P<room_id>\d+)/messages/(?P<item_id>\d+)/$', MessageView.as_view()),
     (r'^rooms/(?P<room_id>\d+)/members/$', MemberView.as_view()),
     (r'^rooms/(?P<room_id>\d+)/members/(?P<user_id>\d+)/$', MemberView.as_view()),
+    (r'^metrics/$', metrics_view),
 )
\ No newline at end of file
@@ -1,9 +1,75 @@
+from collections import OrderedDict
+from datetime import timezone
+
 from django.views.generic import View
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
+from django.utils.dateparse import parse_datetime
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 
+from . import metrics
+from .cache import get_recent_messages, recent_messages_version, set_recent_messages
 from .decorators import json, room_stream_subscriber, room_stream_publisher
 from .models import Room, User, Message
+from .publisher import get_publisher
+from .realtime import get_realtime_backend
+from .pagination import (encode_message_cursor, decode_message_cursor, paginate_by_id, paginate_by_recency,
+                         stream_by_id)
+
+
+def _flag(json_data, name):
+    """ Read a boolean parameter, given as 1/true/yes or 0/false/no.
+    :return: False if the parameter is missing
+    :raises ValueError: If the value isn't one of those
+    """
+    value = str(json_data.get(name, "")).lower()
+
+    if value in ("1", "true", "yes"):
+        return True
+    elif value in ("", "0", "false", "no"):
+        return False
+
+    raise ValueError("Invalid %s: %s" % (name, json_data[name]))
+
+
+def _includes(json_data, supported):
+    """ Parse the comma separated include= list.
+    :param supported: Names that may be included
+    :return: Set of names
+    :raises ValueError: If an unsupported name is asked for
+    """
+    includes = set(filter(None, json_data.get("include", "").split(",")))
+    unsupported = includes - set(supported)
+
+    if unsupported:
+        raise ValueError("Unsupported include: %s" % ", ".join(sorted(unsupported)))
+
+    return includes
+
+
+def _timestamp(value):
+    """ Parse a timestamp given in ISO 8601 format, as the API returns them.
+    :return: Naive datetime in UTC, as the models store them
+    :raises ValueError: If the value isn't a timestamp
+    """
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+
+    if parsed is None:
+        raise ValueError("Invalid timestamp: %s" % value)
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def _first_or_404(query_set):
+    """ Return the first result of a query set, or raise Http404 if there is none. """
+    item = query_set.first()
+
+    if item is None:
+        raise Http404("No matching object")
+
+    return item
 
 
 class CRUDView(View):
@@ -12,6 +78,21 @@ class CRUDView(View):
     All verb implementations expect to receive and return dictionary objects.  All serialization/deserialization
     is handled outside of the view itself.
     """
+    # Collection paging limits
+    _page_size = 100
+    _max_page_size = 1000
+    _stream_chunk_size = 500
+
+    # Maximum number of objects that can be looked up at once with ids=
+    _max_ids = 100
+
+    # Summaries that can be added to each object with include=: name, and (function adding the summary to a list of
+    # public representations, function returning a validator for the summaries)
+    _summaries = {}
+
+    # Orders, other than by ID, that a page of the collection can be listed in with sort=: name, and (timestamp field
+    # listed newest first, function returning a validator for the order)
+    _sorts = {}
 
     @json
     def post(self, json_data, *args, **kwargs):
@@ -20,22 +101,170 @@ class CRUDView(View):
         :return: Public representation of the created model.  This may not include all model fields, depending
                 on how the model defines its to_data() member.
         """
+        invalid = self._check_writable(json_data)
+        if invalid:
+            return invalid
+
         return self._model(**json_data).save()
 
     @json
     def get(self, json_data, item_id=None, *args, **kwargs):
         """ GET verb handler (database read)
-        :param json_data: Not used.
-        :param item_id: (optional) Unique ID of the object to retrieve.  If not specified, all objects will be returned.
+        :param json_data: Optional "limit" and "cursor" paging parameters, "stream" to read the whole collection, or
+                "ids" (a comma separated list) to look up specific objects.  "fields" (a comma separated list) narrows
+                the representation of each object to those fields, plus the ID, and "include" (a comma separated list)
+                adds summaries to each object.  "sort" lists a page in one of the supported orders instead of by ID.
+        :param item_id: (optional) Unique ID of the object to retrieve.  If not specified, a page of objects will be
+                returned.
         :return: Public representation of the requested object (if item_id specified) or a dictionary containing a
-                single key referencing a list of public representations of all available objects in this collection.
+                single key referencing a list of public representations of one page of this collection, plus a
+                "cursor" key for the next page.  Objects looked up by ID are listed in the order requested, leaving
+                out any that don't exist, with no cursor.
         """
+        try:
+            fields = self._model.parse_fields(json_data.get("fields"))
+            includes = _includes(json_data, self._summaries)
+            sort = self._sort(json_data)
+            stream = _flag(json_data, "stream")
+        except ValueError as ex:
+            return HttpResponse(str(ex), status=400)
+
         if item_id:
-            return get_object_or_404(self._model, id=item_id).to_data()
-        else:
-            return {
-                self._collection_name: [item_obj.to_data() for item_obj in self._model.objects.all()]
-            }
+            if fields:
+                item = _first_or_404(self._model.data_values(self._model.objects.filter(id=item_id), fields))
+            else:
+                item = get_object_or_404(self._model, id=item_id).to_data()
+
+            return self._summarize([item], includes)[0]
+
+        if "ids" in json_data:
+            try:
+                return {
+                    self._collection_name: self._summarize(self._lookup(json_data["ids"], fields), includes)
+                }
+            except ValueError as ex:
+                return HttpResponse(str(ex), status=400)
+
+        if stream:
+            if includes or sort:
+                return HttpResponse("Streamed collections can't be summarized or sorted", status=400)
+
+            # Stream the whole collection, reading it from the database in chunks
+            return StreamingHttpResponse(stream_by_id(self._collection_name, self._model.data_values(fields=fields),
+                                                      self._stream_chunk_size),
+                                         content_type='application/json')
+
+        try:
+            limit = min(int(json_data.get("limit", self._page_size)), self._max_page_size)
+            if limit < 1:
+                raise ValueError("Invalid limit: %d" % limit)
+
+            if sort:
+                items, cursor = self._sorted_page(sort, fields, limit, json_data.get("cursor"))
+            else:
+                items, cursor = paginate_by_id(self._model.data_values(fields=fields), limit, json_data.get("cursor"))
+        except ValueError as ex:
+            return HttpResponse(str(ex), status=400)
+
+        return {
+            self._collection_name: self._summarize(items, includes),
+            "cursor": cursor
+        }
+
+    def _check_writable(self, json_data):
+        """ Check that a create or update only sets the model's public fields, and not its ID or anything the model
+        maintains itself (e.g. counters and versions).
+        :return: Error response, or None if the data is acceptable
+        """
+        if not isinstance(json_data, dict):
+            return HttpResponse("Expected an object", status=400)
+
+        unsupported = set(json_data) - (set(self._model.white_list(self._model)) - {"id"})
+        if unsupported:
+            return HttpResponse("Unsupported fields: %s" % ", ".join(sorted(unsupported)), status=400)
+
+        return None
+
+    def _sort(self, json_data):
+        """ Parse the requested order.
+        :return: Name of the order, or None to list by ID
+        :raises ValueError: If an unsupported order is asked for
+        """
+        sort = json_data.get("sort")
+
+        if sort and sort not in self._sorts:
+            raise ValueError("Unsupported sort: %s" % sort)
+
+        return sort or None
+
+    def _sorted_page(self, sort, fields, limit, cursor):
+        """ Read one page of the collection in the given order.
+        :return: (items, next cursor) tuple
+        """
+        field = self._sorts[sort][0]
+        names = fields or [name for name, attname in self._model.serializer_plan()]
+
+        # The sort field is read for the cursor, and only returned if it's part of the representation anyway
+        items, cursor = paginate_by_recency(self._model.data_values(fields=names + [field]), field, limit, cursor)
+
+        if field not in names:
+            for item in items:
+                del item[field]
+
+        return items, cursor
+
+    def _summarize(self, items, includes):
+        """ Add the summaries asked for to a list of public representations. """
+        for include in sorted(includes):
+            self._summaries[include][0](items)
+
+        return items
+
+    def _lookup(self, ids, fields=None):
+        """ Look up a set of objects with a single query.
+        :param ids: Comma separated list of IDs
+        :param fields: (optional) Sparse fieldset, as returned by parse_fields()
+        :return: Public representations of the objects found, in the order their IDs were given
+        :raises ValueError: If the list is malformed or too long
+        """
+        try:
+            requested = [int(item_id) for item_id in ids.split(",") if item_id]
+        except ValueError:
+            raise ValueError("Invalid ids: %s" % ids)
+
+        # Keep the first occurrence of each ID
+        requested = list(OrderedDict.fromkeys(requested))
+
+        if len(requested) > self._max_ids:
+            raise ValueError("At most %d ids may be looked up at once" % self._max_ids)
+
+        query_set = self._model.data_values(self._model.objects.filter(id__in=requested), fields)
+        found = {item["id"]: item for item in query_set}
+        return [found[item_id] for item_id in requested if item_id in found]
+
+    def _etag(self, json_data, item_id=None, *args, **kwargs):
+        """ Validator for GET responses.  Collections change whenever any of their objects does, and summaries or
+        orders whenever their own validators do.
+        """
+        if item_id:
+            return None
+
+        try:
+            includes = _includes(json_data, self._summaries)
+            sort = self._sort(json_data)
+        except ValueError:
+            return None
+
+        versions = [self._summaries[include][1] for include in sorted(includes)]
+        if sort:
+            versions.append(self._sorts[sort][1])
+
+        if not versions:
+            return self._model.collection_version()
+
+        # Summaries and orders may share a validator, which only needs to be read once
+        versions = list(OrderedDict.fromkeys(versions))
+        return (self._model.collection_version(),) + tuple(version() for version in versions)
 
     @json
     def put(self, json_data, item_id, *args, **kwargs):
@@ -44,6 +273,10 @@ class CRUDView(View):
         :param item_id: Unique ID of the object to update.
         :return: Public representation of the updated object
         """
+        invalid = self._check_writable(json_data)
+        if invalid:
+            return invalid
+
         existing_item = get_object_or_404(self._model, id=item_id)
         existing_item.update_data(**json_data)
         return existing_item.save()
@@ -60,10 +293,37 @@ class CRUDView(View):
 
 
 class RoomView(CRUDView):
-    """ View for the Room model.  Uses the default CRUDView implementation. """
+    """ View for the Room model.  Uses the default CRUDView implementation, with an activity summary (include=activity)
+    and an order by most recent activity (sort=activity) for room lists.
+    """
     _model = Room
     _collection_name = "rooms"
 
+    _summaries = {
+        "activity": (Room.add_activity, Room.activity_version),
+    }
+
+    _sorts = {
+        "activity": ("last_activity", Room.activity_version),
+    }
+
+    @json
+    def put(self, json_data, item_id, *args, **kwargs):
+        """ PUT verb handler.  Only the room's public fields can be changed.  Its counters and membership version are
+        maintained as messages are posted and members come and go, so only the changed fields are written, and a
+        concurrent post or join isn't overwritten.
+        :param json_data: Dictionary of key/value pairs that should be updated on the room
+        :param item_id: Unique ID of the room to update
+        :return: Public representation of the updated room
+        """
+        invalid = self._check_writable(json_data)
+        if invalid:
+            return invalid
+
+        existing_item = get_object_or_404(Room, id=item_id)
+        existing_item.update_data(**json_data)
+        return existing_item.save(update_fields=sorted(json_data))
+
 
 class UserView(CRUDView):
     """ View for the User model.  Uses the default CRUDView implementation. """
@@ -73,6 +333,20 @@ class UserView(CRUDView):
 
 class MessageView(View):
     """ View for the Message model.  Needs to retrieve 50 messages at a time, and no support for updates. """
+    # Number of messages returned per page
+    _page_size = 50
+
+    # Maximum number of messages replayed to a reconnecting stream subscriber
+    _replay_limit = 200
+
+    # Maximum number of messages accepted in one POST
+    _max_batch_size = 1000
+
+    # Related objects that can be sideloaded with include=: key in the page, and model
+    _sideloads = {
+        "user": ("users", User),
+    }
+
     @staticmethod
     def _stream_name(room_id):
         return 'messages-' + room_id
@@ -80,42 +354,224 @@ class MessageView(View):
     @room_stream_publisher
     @json
     def post(self, json_data, room_id):
-        """ Add a new message to the specified room.
-        :param json_data: Message data to create
+        """ Add a new message, or a list of messages, to the specified room.
+        :param json_data: Message data to create, or a list of message data
         :param room_id: Unique ID of the room to which we're adding the message
-        :return: Message data
+        :return: Message data, or an object with a "messages" key for a list of messages
         """
-        json_data["room"] = get_object_or_404(Room, id=room_id)
+        room = get_object_or_404(Room, id=room_id)
+
+        if isinstance(json_data, list):
+            if not json_data or len(json_data) > self._max_batch_size:
+                return HttpResponse("Between 1 and %d messages may be posted at once" % self._max_batch_size,
+                                    status=400)
+
+            try:
+                messages = room.add_messages(json_data)
+            except ValueError as ex:
+                return HttpResponse(str(ex), status=400)
+
+            self._refresh_newest_page(room, len(messages))
+            return {
+                "messages": messages
+            }
+
+        json_data["room"] = room
 
         if "user" not in json_data:
             return HttpResponse("User is a required field", status=400)
 
+        if "timestamp" in json_data:
+            try:
+                json_data["timestamp"] = _timestamp(json_data["timestamp"])
+            except ValueError as ex:
+                return HttpResponse(str(ex), status=400)
+
+        if not Message.valid_text(json_data.get("msg")):
+            return HttpResponse("msg must be text of 1 to %d characters" % Message._meta.get_field('msg').max_length,
+                                status=400)
+
         json_data["user"] = get_object_or_404(User, id=json_data["user"])
-        return Message.objects.create(**json_data).to_data()
+
+        # save() reports database errors as a response, which must not be published as a new message
+        result = Message(**json_data).save()
+        if isinstance(result, HttpResponse):
+            return result
+
+        self._refresh_newest_page(room, 1)
+        return result
 
     @room_stream_subscriber
     @json
     def get(self, json_data, room_id, item_id=None, *args, **kwargs):
         """
-        :param json_data: Not used.
+        :param json_data: Optional "before" or "after" paging cursors, "include=user" to sideload the authors of
+                the messages returned, and "fields" (a comma separated list) to narrow each message to those fields,
+                plus its ID and timestamp.
         :param room_id: Unique ID of the room from which we're retrieving messages.
         :param item_id: (optional) If specified, return the message with this item_id.
-        :return:
+        :return: Message data, or a page of messages.  With include=user, the page has a "users" key mapping the ID
+                of each author to their public representation.
         """
+        try:
+            includes = _includes(json_data, self._sideloads)
+            fields = Message.parse_fields(json_data.get("fields"))
+        except ValueError as ex:
+            return HttpResponse(str(ex), status=400)
+
+        if fields and includes:
+            # Sideloading needs the IDs of the related objects
+            fields = Message.parse_fields(",".join(fields + sorted(includes)))
+
+        # The cache only holds complete representations
+        newest_page = not item_id and "before" not in json_data and "after" not in json_data and not fields
+
+        # The newest page of a room is served from the cache when possible, without touching the database at all
+        if newest_page:
+            page = get_recent_messages(room_id)
+
+            if page is not None:
+                return self._sideload(page, includes)
+
+            # Taken before reading the page, so that a page missing messages posted meanwhile is never served as
+            # current
+            version = recent_messages_version(room_id)
+
         room = get_object_or_404(Room, id=room_id)
 
         # Return just the message specified
         if item_id:
+            if fields:
+                return _first_or_404(Message.data_values(Message.objects.filter(id=item_id, room=room), fields))
+
             msg = get_object_or_404(Message, id=item_id, room=room)
             return msg.to_data()
 
-        if "before" in json_data:
-            msg = get_object_or_404(Message, id=json_data["before"])
-        else:
-            msg = None
+        if "before" in json_data and "after" in json_data:
+            return HttpResponse("Only one of before and after may be specified", status=400)
+
+        try:
+            before = self._cursor_position(room, json_data.get("before"))
+            after = self._cursor_position(room, json_data.get("after"))
+        except ValueError as ex:
+            return HttpResponse(str(ex), status=400)
+
+        if newest_page:
+            page = self._newest_page(room, version, get_recent_messages(room.id, appended=True))
+            return self._sideload(page, includes)
+
+        # Return up to 50 messages from this room
+        page = room.messages(before=before, after=after, msg_count=self._page_size, rendered=not fields,
+                             fields=fields)
+        return self._sideload(page, includes)
+
+    def _newest_page(self, room, version, cached):
+        """ Read the newest page of a room's history and cache it.
+        :param version: Version returned by recent_messages_version() before anything was read
+        :param cached: (optional) Cached page that only lacks messages appended since it was cached, so that just
+                those are read and merged into it
+        """
+        page = room.newer_messages(cached, msg_count=self._page_size) if cached is not None else None
+
+        if page is None:
+            page = room.messages(msg_count=self._page_size, rendered=True)
+
+        set_recent_messages(room.id, page, version)
+        return page
+
+    def _refresh_newest_page(self, room, posted):
+        """ Merge newly posted messages into a room's cached newest page, if it has one, rather than leaving the next
+        read to fetch the whole page again.
+        :param posted: Number of messages posted
+        """
+        version = recent_messages_version(room.id)
+        cached = get_recent_messages(room.id, appended=True)
+
+        if cached is not None:
+            # Enough new messages to fill the page make up all of it, so there's nothing worth merging
+            self._newest_page(room, version, cached if posted < self._page_size else None)
+
+    def _sideload(self, page, includes):
+        """ Add the related objects asked for to a page of messages, each distinct object once, keyed by ID. """
+        if not includes:
+            return page
+
+        page = dict(page)
+
+        for include in includes:
+            key, model = self._sideloads[include]
+            related_ids = {msg[include] for msg in page["messages"]}
+            page[key] = {str(item["id"]): item for item in model.data_values(model.objects.filter(id__in=related_ids))}
+
+        return page
+
+    @classmethod
+    def _etag(cls, json_data, room_id, item_id=None, *args, **kwargs):
+        """ Validator for GET responses: the room's message counters, which every message written moves, and the
+        version of any sideloaded collection.  Always read from the database, as a cached page may be another
+        process's stale copy.
+        """
+        if item_id:
+            return None
+
+        try:
+            sideload_versions = tuple(cls._sideloads[include][1].collection_version()
+                                      for include in sorted(_includes(json_data, cls._sideloads)))
+        except ValueError:
+            return None
+
+        version = Room.message_version_of(room_id)
+        if version is None:
+            return None
 
-        # Return the last 50 messages from this room
-        return room.messages(since_msg=msg, msg_count=50)
+        return version + sideload_versions
+
+    @staticmethod
+    def _cursor_position(room, cursor):
+        """ Translate a paging cursor received from a client into a (timestamp, id) position.
+        :param room: Room being paged through.
+        :param cursor: Opaque cursor string, a legacy message ID, or None.
+        :return: (timestamp, id) tuple, or None if no cursor was given.
+        """
+        if not cursor:
+            return None
+
+        if cursor.isdigit():
+            # Legacy clients page by message ID, which costs a lookup to find the cursor position
+            msg = get_object_or_404(Message, id=cursor, room=room)
+            return msg.timestamp, msg.id
+
+        return decode_message_cursor(cursor)
+
+    def _replay_events(self, room_id, last_event_id):
+        """ Build the events a reconnecting subscriber missed since the event it last saw.
+        :param room_id: Room the subscriber is listening to.
+        :param last_event_id: Value of the Last-Event-ID header, which is a message cursor.
+        :return: List of (event, event_id, data) tuples, oldest first.
+        """
+        room = get_object_or_404(Room, id=room_id)
+        missed = room.messages(after=decode_message_cursor(last_event_id), msg_count=self._replay_limit + 1,
+                               rendered=True)
+
+        if len(missed["messages"]) > self._replay_limit:
+            # Too far behind to replay efficiently, ask the client to reload the history instead
+            return [("reset", None, {})]
+
+        return [("create", self._event_id(msg), msg) for msg in missed["messages"]]
+
+    def _stream_events(self, event, data):
+        """ Split the data returned by a message POST into stream events, one per message.
+        :param event: Event name
+        :param data: Data returned by post()
+        :return: List of (event, event_id, data) tuples
+        """
+        messages = data["messages"] if "messages" in data else [data]
+        return [(event, self._event_id(msg), msg) for msg in messages]
+
+    @staticmethod
+    def _event_id(data):
+        """ Stream event ID for a message, used by clients to resume with Last-Event-ID. """
+        return encode_message_cursor(data["timestamp"], data["id"])
 
     def put(self, *args, **kwargs):
         """ Message updates are not supported. """
@@ -123,17 +579,33 @@ class MessageView(View):
 
 
 class MemberView(View):
+    """ View for a room's members.  Changes are returned (and published) as join/leave deltas numbered with the room's
+    membership version.  Clients that notice a gap in the version numbers should read a fresh snapshot.
+    """
 
     @staticmethod
     def _stream_name(room_id):
         return 'members-' + room_id
 
+    @staticmethod
+    def _delta(change, user, version):
+        """ Build a membership delta.
+        :param change: Either "join" or "leave"
+        :param user: User who joined or left
+        :param version: Membership version of the room after the change
+        """
+        return {
+            "type": change,
+            "user": user.to_data(),
+            "version": version
+        }
+
     @room_stream_publisher
     @json
     def post(self, json_data, room_id):
         """ Add a member to the specified room.
-        :param json_data: Dictionary containing at least "user_id" as a key
-        :return: Public representation of this room's member list.
+        :param json_data: Dictionary containing at least "user" as a key
+        :return: Join delta for the new member.
         """
         # Load up the specified room
         room = get_object_or_404(Room, id=room_id)
@@ -145,29 +617,46 @@ class MemberView(View):
         # Load up the specified user
         user = get_object_or_404(User, id=json_data["user"])
 
-        # Return an error if this user already existing in the room
-        if user in room.members.all():
-            return HttpResponse("User is already a member of this room", status=409)
+        # The unique (room, user) constraint refuses a user who is already a member
+        version = room.add_member(user.id)
 
-        # Add the user to the room, save, and return
-        room.members.add(user)
-        room.save()
+        if version is None:
+            return HttpResponse("User is already a member of this room", status=409)
 
-        return room.member_data()
+        return self._delta("join", user, version)
 
     @room_stream_subscriber
     @json
     def get(self, json_data, room_id, user_id=None):
         """ Get the list of members in the specified room.
-        :param json_data: Not used.
+        :param json_data: Optional "fields" (a comma separated list) to narrow each member to those fields, plus the ID.
         :param room_id: Room to get members from.
-        :return: Object with a list of members in the specified room.
+        :return: Object with a list of members in the specified room, and the membership version it reflects.
         """
         if user_id:
             return HttpResponse("Reading a specific member is not supported", status=400)
 
+        try:
+            fields = User.parse_fields(json_data.get("fields"))
+        except ValueError as ex:
+            return HttpResponse(str(ex), status=400)
+
         room = get_object_or_404(Room, id=room_id)
-        return room.member_data()
+        return room.member_data(fields)
+
+    @staticmethod
+    def _etag(json_data, room_id, user_id=None):
+        """ Validator for GET responses: the room's membership version, and the version of the users collection, which
+        changes when a member edits their nick or avatar.
+        """
+        if user_id:
+            return None
+
+        member_version = Room.member_version_of(room_id)
+        if member_version is None:
+            return None
+
+        return member_version, User.collection_version()
 
     def put(self, *args, **kwargs):
         """ Member updates are not supported. """
@@ -180,16 +669,31 @@ class MemberView(View):
         :param json_data: Not used.
         :param room_id: Room from which to remove the user
         :param user_id: User to remove
-        :return: Status 204 on success, error message on failure
+        :return: Status 204 and a leave delta on success, error message on failure
         """
         room = get_object_or_404(Room, id=room_id)
         user = get_object_or_404(User, id=user_id)
 
-        if user not in room.members.all():
+        # Remove the user from the room and return
+        version = room.remove_member(user.id)
+
+        if version is None:
             return HttpResponse("User is not a member of this room", status=400)
 
-        # Remove the user from the room, save, and return
-        room.members.remove(user)
-        room.save()
+        return self._delta("leave", user, version)
+
+
+def metrics_view(request):
+    """ Expose the in-process performance metrics, and the publisher's and realtime backend's counters, in the
+    Prometheus text format.
+    """
+    extra = {}
+    for name, value in get_publisher().stats().items():
+        metric_type = "gauge" if name in ("queue_depth", "max_queue_depth") else "counter"
+        extra["chat_publisher_" + name] = (metric_type, "Stream publisher %s" % name.replace('_', ' '), value)
+
+    for name, value in get_realtime_backend().stats().items():
+        metric_type = "gauge" if name in ("streams", "subscribers") else "counter"
+        extra["chat_realtime_" + name] = (metric_type, "Realtime backend %s" % name, value)
 
-        return user.to_data()
+    return HttpResponse(metrics.render(extra), content_type='text/plain; version=0.0.4')
@@ -0,0 +1,31 @@
+"""
+Gunicorn configuration for the chat API.
+
+Requests spend most of their time waiting on the database, the cache or the GRIP proxy, and event stream subscribers
+held by the in-process hub wait indefinitely.  The default gevent workers serve each request from a greenlet instead
+of a thread, so one process can keep many such requests in flight; the standard library is monkey patched by gunicorn,
+and psycopg2 is made cooperative below.
+
+Each greenlet with a request in flight holds its own database connection, so WEB_CONCURRENCY * GUNICORN_CONNECTIONS
+must stay within what the database (or a pooler such as pgbouncer in front of it) accepts.
+
+Set GUNICORN_WORKER_CLASS=sync to go back to one request per worker process.
+"""
+
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 100))
+
+# Event streams stay open far longer than gunicorn's default 30 second timeout.  gevent workers keep heartbeating
+# while requests wait, so the timeout only applies to workers that are genuinely stuck.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # Let other greenlets run while one waits on PostgreSQL
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -47,6 +47,9 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     #'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.middleware.MetricsMiddleware',
+    'chat.middleware.SlowQueryMiddleware',
+    'chat.middleware.ProfilingMiddleware',
 )
 
 ROOT_URLCONF = 'server.urls'
@@ -84,4 +87,51 @@ STATIC_URL = '/static/'
 
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
-)
\ No newline at end of file
+)
+
+# Caching.  Room member ID sets are cached, so with more than one worker process this should point at a shared
+# backend (e.g. memcached) for joins and leaves made by one process to be seen by the others.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Stream events are published from a background worker, which coalesces the events for each stream over a short
+# window into a single proxy call.  Set CHAT_PUBLISH_ASYNC to False to publish from the request thread instead.
+CHAT_PUBLISH_ASYNC = True
+CHAT_PUBLISH_WINDOW = 0.05
+CHAT_PUBLISH_QUEUE_SIZE = 10000
+CHAT_PUBLISH_PUT_TIMEOUT = 0.01
+
+# Cache of the newest page of each room's history.  The in-process LRU is fastest; with several worker processes its
+# timeout bounds how long one process can miss messages posted through another.  Use chat.cache.DjangoCacheBackend
+# (OPTIONS: alias, timeout) to share the windows through one of the CACHES instead.
+CHAT_RECENT_MESSAGES_CACHE = {
+    'BACKEND': 'chat.cache.LocalLRUBackend',
+    'OPTIONS': {
+        'max_entries': 1000,
+        'timeout': 5,
+    },
+}
+
+# Realtime delivery.  GripBackend hands event streams to a GRIP proxy.  chat.realtime.HubBackend holds them in this
+# process instead, for development, CI and single process deployments without a proxy.
+CHAT_REALTIME_BACKEND = {
+    'BACKEND': 'chat.realtime.GripBackend',
+}
+
+# Request profiling.  Requests carrying an "X-Chat-Profile: <token>" header, plus a random sample of all requests, are
+# run under the profiler and their call graph and SQL written to CHAT_PROFILE_DIR.  Off unless either is set.  Only
+# the newest CHAT_PROFILE_MAX_FILES profiles are kept.
+CHAT_PROFILE_TOKEN = os.environ.get('CHAT_PROFILE_TOKEN')
+CHAT_PROFILE_SAMPLE_RATE = float(os.environ.get('CHAT_PROFILE_SAMPLE_RATE', 0))
+CHAT_PROFILE_DIR = os.environ.get('CHAT_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+CHAT_PROFILE_MAX_FILES = int(os.environ.get('CHAT_PROFILE_MAX_FILES', 500))
+
+# Slow query capture.  Queries taking longer than CHAT_SLOW_QUERY_THRESHOLD seconds are explained and recorded, see
+# "manage.py slow_queries".  EXPLAIN ANALYZE runs the query a second time, so it's off by default.
+CHAT_SLOW_QUERY_THRESHOLD = (float(os.environ['CHAT_SLOW_QUERY_THRESHOLD'])
+                             if 'CHAT_SLOW_QUERY_THRESHOLD' in os.environ else None)
+CHAT_SLOW_QUERY_ANALYZE = False
+CHAT_SLOW_QUERY_MAX_ENTRIES = 100
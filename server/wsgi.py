@@ -1,7 +1,8 @@
 """
 WSGI config for chat project.
 
-It exposes the WSGI callable as a module-level variable named ``application``.
+It exposes the WSGI callable as a module-level variable named ``application``.  In production it is served by
+gunicorn with gevent workers, see gunicorn_conf.py.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/1.7/howto/deployment/wsgi/